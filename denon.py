@@ -29,22 +29,179 @@
 
 class HelpException(Exception):
 
-    def __init__(self, message):
+    def __init__(self, message, error = None, **details):
 
         self.message = message
 
+        # kind of error and its details for structured replies, e.g. of
+        # HTTP gateway, see error_json()
+        self.error = error
+        self.details = details
+
 
 
 
-import serial.tools.list_ports
 import sys
 import time
 import re
+import os
+import json
+import contextlib
+import signal
+import threading
+import queue
+import collections
+import shlex
+import heapq
+import errno
+import struct
+import termios
+import io
 
 # Force serial port by setting the constant, e.g.
 # PORT = "/dev/ttyUSB0"
 PORT = None
 
+# Serial adapters that are found by USB vendor id, product id and optional
+# serial number if PORT isn't set, e.g. (0x067b, 0x2303, "A1B2C3") in order
+# to choose one of several PL2303 adapters
+ADAPTERS = [
+    (0x067b, 0x2303, None)
+]
+
+# Serial device that has been found last time, it is used as long as it
+# exists instead of searching all serial devices again
+PORT_CACHE = os.path.expanduser("~/.cache/denon.port")
+
+# Retries with doubled delay in seconds if serial device is locked by
+# another process, e.g. by daemon
+OPEN_RETRIES = 4
+OPEN_BACKOFF = .1
+
+# Serial port is treated as dead if writing a frame takes longer, it is
+# reopened and sending is resumed with the frame that has failed
+WRITE_TIMEOUT = .5
+
+# Seconds to wait for serial device to come back, e.g. if USB adapter has
+# been plugged again, and interval in seconds to look for it
+RECONNECT_TIMEOUT = 10
+RECONNECT_INTERVAL = .05
+
+# Break that starts frames, also see section [serial] of config file:
+# "frame" - break before each frame
+# "burst" - break once before frames that are written together
+# "none"  - no break
+# In modes "burst" and "none" frames of commands without gap, e.g. if pacing
+# of class is 0, are written together
+BREAK = "frame"
+BREAK_MODES = [ "frame", "burst", "none" ]
+
+# Duration of break in seconds, a shorter break may be sufficient
+BREAK_DURATION = .25
+
+# Unix socket of "denon.py daemon", clients forward their commands to it
+SOCKET = "/tmp/denon.sock"
+
+# Optional config file, e.g. in order to override pacing or to name serial
+# devices of several receivers for option --group
+#
+# [pacing]
+# keypad = .2
+# power = 3
+#
+# [serial]
+# break = burst
+# break_duration = .05
+#
+# [ports]
+# living = /dev/ttyUSB0
+# kitchen = /dev/ttyUSB1
+CONFIG = os.path.expanduser("~/.denon.conf")
+
+# Gap in seconds after a command of a class before next command is sent
+PACING = {
+    "power" : 2.0,
+    "source" : 1.2,
+    "volume" : .3,
+    "sound" : .4,
+    "step" : .15,
+    "keypad" : .3,
+    "menu" : .5,
+    "playback" : .5,
+    "settings" : .8,
+    "wait" : 1.2,
+    "default" : .8
+}
+
+# Lower limit for gaps that are tightened at runtime
+PACING_MIN = .1
+
+# Read and decode status frames sent by receiver in background
+READ_STATUS = False
+
+# Wait for acknowledgement of receiver instead of gap after each command,
+# can also be activated by option --ack
+ACK = False
+
+# Skip commands that don't change known state of receiver, e.g. "fm" if
+# FM is already the active source, can also be activated by option --elide
+ELIDE = False
+
+# Levels of sound settings, the receiver steps one level per command
+LEVELS = {
+    "bass" : range(-8, 9),
+    "treble" : range(-8, 9),
+    "balance" : range(-8, 9)
+}
+
+# Step to lowest level first if current level is unknown, can also be
+# activated by option --reset-levels
+RESET_LEVELS = False
+
+# Drop commands that are superseded or cancelled by following commands,
+# e.g. "vol 10 vol 12" or "bass + bass -", see option --no-coalesce
+COALESCE = True
+
+# Priorities of requests in daemon mode, lower value is sent first. Macros
+# and scripts are interrupted between their steps by interactive commands
+PRIORITIES = {
+    "mute" : 0,
+    "vol" : 0,
+    "off" : 0,
+    "macro" : 2,
+    "-" : 2,
+    "-f" : 2,
+    "scene" : 2,
+    "default" : 1
+}
+
+# Drop requests that are not done after seconds in daemon mode, can also
+# be set by option --deadline <seconds>
+DEADLINE = None
+
+# File that metrics are written to in Prometheus text format after each
+# call or request of daemon, e.g. for textfile collector of node exporter,
+# can also be set by option --metrics <file>
+METRICS = None
+
+# Captures of option --record start with RECORD_MAGIC followed by a record
+# per command: seconds since start of capture (double), length of frame
+# (byte), length of rc command (short), frame and rc command as UTF-8. Frame
+# is empty for commands that aren't sent, e.g. wait
+RECORD_MAGIC = b"DENON\x01"
+
+# Upper bounds in seconds of buckets of latency histograms
+METRICS_BUCKETS = [ .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5 ]
+
+# Named serial devices for option --group, also see section [ports] of
+# config file
+PORTS = {}
+
+# Named target states for command scene, e.g. { "evening" : { "source" : "fm",
+# "preset" : "24", "volume" : "12" } }, also see sections [scene <name>] of
+# config file. Only settings that differ from known state are sent
+SCENES = {}
+
 __PARSE_IDX = "#"
 __PARSE_VAL = "$"
 __PARSE_MUL = "*"
@@ -57,6 +214,15 @@ __PARSER = "parser"
 
 __PARAM = -1
 
+__RECORD = struct.Struct("<dBH")
+
+__PARAM_RANGE = 0
+__PARAM_DICT = 1
+__PARAM_REGEX = 2
+
+# help text of all commands, see __help()
+__help_text = None
+
 COMMANDS = {
     "on" : {
          __USAGE : "on",
@@ -147,8 +313,8 @@ COMMANDS = {
              }]
          },
      "bass" : {
-         __USAGE : "bass <+|->",
-         __DESCR : "Increases / decreases bass level",
+         __USAGE : "bass <+|-|-8..8>",
+         __DESCR : "Increases / decreases bass level or sets level",
          __STATS : [ 66, 0, 1, __PARAM ],
          __PARAMS : [{
              "+" : 0,
@@ -156,8 +322,8 @@ COMMANDS = {
              }]
          },
      "treble" : {
-         __USAGE : "treble <+|->",
-         __DESCR : "Increases / decreases treble level",
+         __USAGE : "treble <+|-|-8..8>",
+         __DESCR : "Increases / decreases treble level or sets level",
          __STATS : [ 66, 0, 2, __PARAM ],
          __PARAMS : [{
              "+" : 0,
@@ -165,8 +331,9 @@ COMMANDS = {
              }]
          },
      "balance" : {
-         __USAGE : "balance <left|right>",
-         __DESCR : "Sets balance one step more to left or right",
+         __USAGE : "balance <left|right|-8..8>",
+         __DESCR : "Sets balance one step more to left or right or sets"
+            + " level, negative levels are left",
          __STATS : [ 66, 0, 3, __PARAM ],
          __PARAMS : [{
              "left" : 0,
@@ -381,20 +548,95 @@ COMMANDS = {
          __DESCR : "Changes to preset with given no"
         },
      "macro set-preset-name" : {
-         __USAGE : "macro set-preset-name <name>",
-         __DESCR : "set name for presets."
+         __USAGE : "macro set-preset-name <nn> <name> [<old name>]",
+         __DESCR : "set name for presets. Only chars that differ from"
+            + " old name are typed if old name is given."
         },
      "macro delete-preset" : {
          __USAGE : "macro delete-preset <from> [<to>]",
          __DESCR : "Deletes tuner presets. Note that it gets out of"
             + " sync in case that preset is not available."
         },
+     "listen" : {
+         __USAGE : "listen",
+         __DESCR : "Prints status frames that are sent by receiver"
+        },
+     "scene" : {
+         __USAGE : "scene <name>",
+         __DESCR : "Applies scene of config file, only settings that differ"
+            + " from known state are sent"
+        },
+     "replay" : {
+         __USAGE : "replay <file> [<factor>|fast]",
+         __DESCR : "Sends commands of capture of option --record again "
+            + "with original timing, faster by factor or paced"
+        },
      "help" : {
          __USAGE : "help",
          __DESCR : "Information about usage, commands and parameters"
         }
     }
 
+__PACING_CLASSES = {
+    "power" : [ "on", "off" ],
+    "source" : [ "fm", "dab", "cd", "net", "analog", "optical", "cda", "usb",
+                 "online", "internet", "server", "ipod" ],
+    "volume" : [ "vol", "mute" ],
+    "sound" : [ "sdb", "sdirect", "mode" ],
+    "step" : [ "bass", "treble", "balance" ],
+    "keypad" : [ "num", "clear", "up", "down", "left", "right" ],
+    "menu" : [ "enter", "search", "info", "preset", "dimmer" ],
+    "playback" : [ "play", "pause", "stop", "next", "previous", "forward",
+                   "rewind", "random", "repeat" ],
+    "settings" : [ "sleep", "standby", "set-alarm", "alarm" ],
+    "wait" : [ "wait" ]
+    }
+
+__STATUS_KINDS = {
+    "on" : "power",
+    "off" : "power",
+    "vol" : "volume",
+    "fm" : "source",
+    "dab" : "source",
+    "cd" : "source",
+    "net" : "source",
+    "analog" : "source",
+    "optical" : "source",
+    "cda" : "source",
+    "usb" : "source",
+    "online" : "source",
+    "internet" : "source",
+    "server" : "source",
+    "ipod" : "source"
+    }
+
+# kinds of state that are set by commands absolutely
+__STATE_KINDS = [ "power", "source", "volume", "mute", "dimmer", "sdb",
+                  "sdirect", "standby", "alarm" ]
+
+# commands that step relatively
+__STEPS = {
+    "bass" : { "+" : 1, "-" : -1 },
+    "treble" : { "+" : 1, "-" : -1 },
+    "balance" : { "right" : 1, "left" : -1 }
+    }
+
+# commands that toggle state
+__TOGGLES = [ "mode" ]
+
+# commands after which nothing is merged with commands before
+__BARRIERS = [ "on", "off", "wait" ]
+
+# options that are followed by a value, see __parse_options()
+__VALUE_OPTIONS = [ "--deadline", "--group", "--metrics", "--record",
+                    "--http" ]
+
+# settings of scenes in order of their dependencies, e.g. power first and
+# source before preset
+__SCENE_ORDER = [ "power", "source", "preset", "volume", "mute", "sdb",
+                  "sdirect", "bass", "treble", "balance", "dimmer",
+                  "standby" ]
+
 KEY_PAD = [["0", " ", "^", "'", "(", ")", "*", "+", ",", "="],
            ["1", ".", "-", "/"],
            ["A", "B", "C", "2"],
@@ -406,9 +648,85 @@ KEY_PAD = [["0", " ", "^", "'", "(", ")", "*", "+", ",", "="],
            ["T", "U", "V", "8"],
            ["W", "X", "Y", "Z", "9"]]
 
+# char of preset name to key and number of presses
+__KEY_INDEX = dict([ (KEY_PAD[key][press], (key, press + 1))
+                     for key in range(len(KEY_PAD))
+                     for press in range(len(KEY_PAD[key])) ])
+
+NAME_LENGTH = 8
+
+# Largest length byte of known frames, i.e. of set-alarm. Status frames that
+# claim to be longer are corrupted
+MAX_FRAME_LENGTH = 7
+
+PRESETS = 40
+
 port = PORT
 ser = None
 
+# known state of receiver, e.g. source and preset, see track_command()
+state = {}
+
+# compiled scenes by name, see __scene_plan()
+__scene_plans = {}
+
+# number entry and menus of receiver
+__entry = {
+    "tens" : 0,
+    "enters" : 0,
+    "cleared" : False,
+    "menu" : False
+    }
+
+# steps in same direction while level is unknown
+__saturation = {}
+
+# state of receiver of this process, see new_receiver()
+__receiver = {
+    "state" : state,
+    "entry" : __entry,
+    "saturation" : __saturation
+    }
+
+# keeps serial port open after sending, e.g. in daemon mode
+keep_open = False
+
+# metrics are written to file after each request in daemon mode
+metrics_file = None
+
+# capture of sent commands, see start_recording()
+recording = None
+__record_start = 0
+
+config_loaded = False
+
+# gaps that have been tightened at runtime
+__pacing = {}
+
+# counters and histograms, see metrics_text()
+__counters = {}
+__histograms = {}
+__metrics_lock = threading.Lock()
+
+# compiled commands, see __command_spec()
+__specs = {}
+
+# payload of frames to command and parameter, see status_frame()
+__payloads = None
+
+# decoded frames of receiver if status is read
+status_frames = queue.Queue()
+reader = None
+
+# time when receiver is ready for next command, also between requests
+ready_at = 0
+
+# queued requests of daemon, see __submit()
+__jobs = []
+__job_seq = 0
+__current = None
+__scheduler = threading.Condition()
+
 
 
 
@@ -420,10 +738,21 @@ def __build_help(cmd, header = False, msg = ""):
         s = """ Denon DRA-F109 command line remote control \
  for Linux / Raspberry Pi via serial port
 
- USAGE:   denon.py [/dev/ttyUSB0] <command1> <params1> <command2> ...
+ USAGE:   denon.py [--ack] [--elide] [--no-coalesce] [--reset-levels]
+                  [--deadline <seconds>] [--group <name>,<name>... [--sync]]
+                  [--metrics <file>] [--record <file>]
+          denon.py daemon [<options>] [--http [<host>:]<port>] [/dev/ttyUSB0]
+                  [/dev/ttyUSB0] <command1> <params1> <command2> ...
+          denon.py [<options>] [/dev/ttyUSB0] -f <script>|-
  EXAMPLE: Set FM radio as input source, select preset 24
           and set volume to 12
           $ ./denon.py fm num +10 num +10 num 4 vol 12
+          Read commands line by line from script
+          $ ./denon.py -f presets.txt
+          Set volume of receivers in living room and kitchen
+          $ ./denon.py --group living,kitchen vol 15
+          Apply scene of config file
+          $ ./denon.py scene evening
         """
 
     if msg != "":
@@ -441,91 +770,335 @@ def __build_help(cmd, header = False, msg = ""):
 
 def __help():
 
-    s = ""
-    i = 0
-    for cmd in sorted(COMMANDS):
-        s += __build_help(COMMANDS[cmd], i == 0)
-        i += 1
+    global __help_text
 
-    return s
+    # help text is built once and only if it is shown
+    if __help_text == None:
+        names = sorted(COMMANDS)
+        __help_text = "".join([ __build_help(COMMANDS[cmd], cmd == names[0])
+                                for cmd in names ])
 
+    return __help_text
 
 
 
-def build_binary_commands_from_rc(rc_commands):
 
-    binary_commands = []
+def build_binary_commands_from_rc(rc_commands, reset_levels = RESET_LEVELS,
+                                  receiver = None):
+
+    return list(iter_binary_commands(rc_commands, reset_levels, receiver))
+
+
+
+
+def iter_binary_commands(rc_commands, reset_levels = RESET_LEVELS,
+                         receiver = None):
+
+    rc_commands = collections.deque(rc_commands)
+
+    # levels of sound settings while building
+    known = (receiver or __receiver)["state"]
+    levels = dict([ (name, known[name]) for name in LEVELS if name in known ])
 
     # process multiple commands
     while len(rc_commands) > 0:
         rc_seq = rc_commands[0]
+        cmd_name = rc_seq
 
-        cmd_def = __interprete_command(rc_commands.pop(0))
+        spec = __interprete_command(rc_commands.popleft())
 
-        raw_seq = cmd_def[__STATS]
-        params = []
+        # lookup prebuilt frame of command and its parameter
+        frames = __frame_table(cmd_name)
+        if None in frames:
+            yield __frame_command(cmd_name, rc_seq, frames[None])
+            continue
 
-        if __PARAMS in cmd_def:
-            cmd_param_def = cmd_def[__PARAMS]
-        else:
-            cmd_param_def = []
+        elif len(rc_commands) > 0 and rc_commands[0] in frames:
+            rc_key = rc_commands.popleft()
+            yield __frame_command(cmd_name, rc_seq + " " + rc_key,
+                                  frames[rc_key])
+            if cmd_name in levels:
+                levels[cmd_name] = __step_level(cmd_name, levels[cmd_name],
+                                                __STEPS[cmd_name][rc_key])
+            continue
 
-        i = -1
+        elif len(rc_commands) > 0 and cmd_name in LEVELS:
+            yield from __level_commands(cmd_name, rc_commands.popleft(),
+                                        levels, reset_levels)
+            continue
 
-        for param_def in cmd_param_def:
+        cmd_def = spec.cmd_def
+        params = []
 
-            i += 1
+        for kind, param_def, parser in spec.params:
 
             # validate parameters
             if len(rc_commands) == 0:
                 # command requires parameters but there are none
                 raise HelpException(__build_help(cmd_def, True,
-                                        "ERROR: Parameter is missing:"))
+                                        "ERROR: Parameter is missing:"),
+                                    "missing-parameter",
+                                    usage = cmd_def[__USAGE])
 
             # interprete given parameters
-            rc_key = rc_commands.pop(0)
+            rc_key = rc_commands.popleft()
             rc_seq += " " + rc_key
 
             # handle parameter of type list (range of int values)
-            if type(param_def) in (tuple, list, range):
+            if kind == __PARAM_RANGE:
                 params.append(__interprete_param_array(cmd_def,
                                                 rc_key,
                                                 param_def))
 
             # handle parameter of type dict (lookup values)
-            elif type(param_def) in (tuple, dict):
+            elif kind == __PARAM_DICT:
                 params.append(__interprete_param_dict(cmd_def,
                                                rc_key,
                                                param_def))
 
             # handle parameter of keywords (lookedup by regexp)
-            elif type(param_def) in (tuple, str):
+            else:
                 params += __interprete_param_regex(cmd_def,
                                                 rc_key,
                                                 param_def,
-                                                cmd_def[__PARSER][i])
+                                                parser)
 
         # collect commands
-        binary_commands.append({
-                "binary" : __replace_params(raw_seq, params),
+        binary = __encode(spec, params)
+        if binary == "__WAIT__":
+            frame = None
+        else:
+            frame = __build_package(binary)
+
+        yield {
+                "cmd" : cmd_name,
+                "binary" : binary,
+                "frame" : frame,
                 "rc_cmd" : rc_seq
-            })
+            }
+
+
+
+
+def __level_commands(cmd_name, cli_arg, levels, reset_levels):
+
+    try:
+        level = int(cli_arg)
+        if level not in LEVELS[cmd_name]:
+            raise ValueError()
+
+    except ValueError:
+        raise HelpException(__build_help(COMMANDS[cmd_name], True,
+                   "ERROR: Value <" + cli_arg
+                   + "> is out of allowed range:"),
+                   "out-of-range", value = cli_arg,
+                   usage = COMMANDS[cmd_name][__USAGE])
+
+    frames = __frame_table(cmd_name)
+    up, down = sorted(__STEPS[cmd_name], key = __STEPS[cmd_name].get,
+                      reverse = True)
+    binary_commands = []
+
+    if cmd_name not in levels:
+        if not reset_levels:
+            raise HelpException(" ERROR: Current level of <" + cmd_name
+                                + "> is unknown. Use option --reset-levels",
+                                "unknown-level", command = cmd_name)
+
+        # receiver ignores steps beyond lowest level
+        for i in range(len(LEVELS[cmd_name]) - 1):
+            cmd = __frame_command(cmd_name, cmd_name + " " + down,
+                                  frames[down])
+            cmd["coalesce"] = False
+            binary_commands.append(cmd)
+
+        levels[cmd_name] = LEVELS[cmd_name][0]
+
+    key = up if level > levels[cmd_name] else down
+    for i in range(abs(level - levels[cmd_name])):
+        binary_commands.append(__frame_command(cmd_name, cmd_name + " " + key,
+                                               frames[key]))
+
+    levels[cmd_name] = level
 
     return binary_commands
 
 
 
 
-def __replace_params(raw_seq, params):
+def __step_level(cmd_name, level, step):
+
+    return min(max(level + step, LEVELS[cmd_name][0]), LEVELS[cmd_name][-1])
+
+
+
+
+def __frame_command(cmd_name, rc_seq, frame):
+
+    return {
+            "cmd" : cmd_name,
+            "binary" : frame[5:-1],
+            "frame" : frame,
+            "rc_cmd" : rc_seq
+        }
+
+
+
+
+def __frame_table(cmd):
+
+    # build all frames of command at once when it is used first, e.g.
+    # vol 0 ... vol 59. Key is parameter of command or None
+    spec = __command_spec(cmd)
+    if spec.frames != None:
+        return spec.frames
+
+    table = {}
+
+    if type(spec.stats) != tuple or len(spec.params) > 1:
+        # dynamic encoding, e.g. set-alarm
+        pass
+
+    elif len(spec.params) == 0:
+        table[None] = __build_package(spec.stats)
+
+    elif spec.params[0][0] == __PARAM_RANGE:
+        for v in spec.params[0][1]:
+            table[str(v)] = __build_package(__encode(spec, [ v ]))
 
-    params.reverse()
+    elif spec.params[0][0] == __PARAM_DICT:
+        for k, v in spec.params[0][1].items():
+            table[k] = __build_package(__encode(spec, [ v ]))
 
-    rv = []
-    for b in raw_seq:
-        if ( b == -1):
-            rv += [ params.pop() ]
+    spec.frames = table
+
+    return table
+
+
+
+
+class CommandSpec:
+
+    # compiled entry of COMMANDS, see __command_spec()
+    __slots__ = ( "name", "cmd_def", "stats", "slots", "params", "frames" )
+
+    def __init__(self, name, cmd_def, stats, slots, params):
+
+        self.name = name
+        self.cmd_def = cmd_def
+        self.stats = stats
+        self.slots = slots
+        self.params = params
+        self.frames = None
+
+
+
+
+def __command_spec(cmd):
+
+    # commands are compiled once when they are used first, i.e. regular
+    # expressions and offsets of parameters in frame
+    if cmd in __specs:
+        return __specs[cmd]
+
+    cmd_def = COMMANDS[cmd]
+
+    stats = cmd_def.get(__STATS)
+    slots = ()
+    if type(stats) == list:
+        stats = tuple(stats)
+        slots = tuple([ i for i in range(len(stats)) if stats[i] == __PARAM ])
+
+    params = []
+    for i, param_def in enumerate(cmd_def.get(__PARAMS, [])):
+        if type(param_def) in (tuple, list, range):
+            params.append((__PARAM_RANGE, param_def, None))
+        elif type(param_def) == dict:
+            params.append((__PARAM_DICT, param_def, None))
         else:
-            rv += [ b ]
+            params.append((__PARAM_REGEX, re.compile(param_def),
+                           tuple(cmd_def[__PARSER][i])))
+
+    spec = CommandSpec(cmd, cmd_def, stats, slots, tuple(params))
+    __specs[cmd] = spec
+
+    return spec
+
+
+
+
+def coalesce_commands(commands):
+
+    keep = [ True ] * len(commands)
+    setters = {}
+    toggles = {}
+    steps = {}
+
+    for i in range(len(commands)):
+        cmd = commands[i]
+        name = cmd["cmd"]
+        args = cmd["rc_cmd"].split()[1:]
+        kind, value = __state_of(name, args[0] if len(args) > 0 else None)
+
+        if name in __BARRIERS or cmd.get("coalesce") == False:
+            __coalesce_steps(keep, steps)
+            setters = {}
+            toggles = {}
+
+        elif kind in __STATE_KINDS or name == "sleep":
+            # absolute setter supersedes previous one
+            if kind in setters:
+                keep[setters[kind]] = False
+            setters[kind] = i
+
+        elif name in __STEPS:
+            steps.setdefault(name, []).append((i, __STEPS[name][args[0]]))
+
+        elif name in __TOGGLES:
+            # toggling twice cancels out
+            if name in toggles:
+                keep[toggles.pop(name)] = False
+                keep[i] = False
+            else:
+                toggles[name] = i
+
+        else:
+            # navigation is never merged and depends on active source
+            setters.pop("source", None)
+            toggles = {}
+
+    __coalesce_steps(keep, steps)
+
+    return [ commands[i] for i in range(len(commands)) if keep[i] ]
+
+
+
+
+def __coalesce_steps(keep, steps):
+
+    # keep last steps in direction of sum of all steps
+    for name in steps:
+        net = sum([ d for i, d in steps[name] ])
+        indices = [ i for i, d in steps[name] if net != 0 and d * net > 0 ]
+        for i, d in steps[name]:
+            keep[i] = False
+
+        for i in indices[len(indices) - abs(net):]:
+            keep[i] = True
+
+    steps.clear()
+
+
+
+
+def __encode(spec, params):
+
+    if type(spec.stats) != tuple:
+        return spec.stats
+
+    rv = list(spec.stats)
+    for i, param in zip(spec.slots, params):
+        rv[i] = param
 
     return rv
 
@@ -537,9 +1110,16 @@ def __interprete_command(cli_cmd):
     if cli_cmd not in COMMANDS:
         raise HelpException(__help()
                         + "\n\n ERROR: Invalid command <"
-                        + cli_cmd + ">\n")
+                        + cli_cmd + ">\n",
+                        "invalid-command", command = cli_cmd)
 
-    return COMMANDS[cli_cmd]
+    spec = __command_spec(cli_cmd)
+    if spec.stats == None:
+        raise HelpException(__build_help(spec.cmd_def, True,
+                   "ERROR: Command can't be combined with other commands:"),
+                   "invalid-command", command = cli_cmd)
+
+    return spec
 
 
 
@@ -547,13 +1127,19 @@ def __interprete_command(cli_cmd):
 def __interprete_param_array(cmd_def, cli_arg, cmd_param_def):
 
     # check if cli_arg is in list of allowed int values
-    if int(cli_arg) not in cmd_param_def:
+    try:
+        value = int(cli_arg)
+    except ValueError:
+        value = None
+
+    if value not in cmd_param_def:
         raise HelpException(__build_help(cmd_def, True,
                    "ERROR: Value <" + cli_arg
-                   + "> is out of allowed range:"))
+                   + "> is out of allowed range:"),
+                   "out-of-range", value = cli_arg, usage = cmd_def[__USAGE])
 
     # return int value of cli_arg as char
-    return int(cli_arg)
+    return value
 
 
 
@@ -564,7 +1150,9 @@ def __interprete_param_dict(cmd_def, cli_arg, cmd_param_def):
     if cli_arg not in cmd_param_def:
         raise HelpException(__build_help(cmd_def, True, "ERROR: Keyword <"
                    + cli_arg
-                   + "> is not allowed here:"))
+                   + "> is not allowed here:"),
+                   "invalid-keyword", value = cli_arg,
+                   usage = cmd_def[__USAGE])
 
     # lookup dict value and return char sequence
     return cmd_param_def[cli_arg]
@@ -574,20 +1162,20 @@ def __interprete_param_dict(cmd_def, cli_arg, cmd_param_def):
 
 def __interprete_param_regex(cmd_def, cli_arg, cmd_param_def, parser):
 
-    # validate parameter by matching regular expression
-    matcher = re.search(cmd_param_def, cli_arg)
-
-    ex = HelpException(__build_help(cmd_def, True,
-                        "ERROR: Syntax of value <"
-                        + cli_arg
-                        + "> is wrong!"))
+    # validate parameter by matching precompiled regular expression
+    matcher = cmd_param_def.search(cli_arg)
 
-    if matcher == None:
-        raise ex
+    b = []
+    if matcher != None:
+        b = __parse(matcher, parser)
 
-    b = __parse(matcher, parser)
     if len(b) == 0:
-        raise ex
+        raise HelpException(__build_help(cmd_def, True,
+                        "ERROR: Syntax of value <"
+                        + cli_arg
+                        + "> is wrong!"),
+                        "invalid-syntax", value = cli_arg,
+                        usage = cmd_def[__USAGE])
 
     return b
 
@@ -611,284 +1199,2567 @@ def __parse(matcher, instruc):
 
 
 
-def send_serial_commands(commands):
+def send_serial_commands(commands, ack = ACK, elide = ELIDE):
+
+    global ready_at
 
     try:
-        __init_serial()
+        if ser == None:
+            __init_serial()
+
+        if ack and reader == None:
+            start_reader()
 
-        n = 0
+        # frames of commands without gap are written together
+        bursts = BREAK != "frame" and not ack
+        burst = []
+
+        skipped = 0
         for cmd in commands:
-            if n > 0:
-                time.sleep(.8)
-            n += 1
+            if elide and is_redundant(cmd):
+                print(" INFO: Skip redundant command <" + cmd["rc_cmd"] + ">")
+                count_metric("denon_commands_skipped_total",
+                             cmd = cmd["cmd"], port = ser.port)
+                skipped += 1
+                continue
+
+            if len(burst) == 0:
+                __sleep(ready_at - time.monotonic())
             print(" INFO: Send command <" + cmd["rc_cmd"] + ">")
 
-            if cmd["binary"] == "__WAIT__":
-                time.sleep(1.2)
+            # receiver needs some time depending on command
+            gap = pacing_gap(cmd["cmd"])
+
+            if cmd["frame"] != None and ack:
+                gap = __send_and_wait_for_ack(cmd)
+                print(" DONE: <" + cmd["rc_cmd"] + ">")
             else:
-                package = __build_package(cmd["binary"])
-                __send_package(package)
+                burst.append(cmd)
 
-            print(" DONE: <" + cmd["rc_cmd"] + ">")
+            track_command(cmd)
+            count_metric("denon_commands_total", cmd = cmd["cmd"],
+                         port = ser.port)
+
+            if gap > 0 or not bursts:
+                __send_burst(burst)
+                ready_at = time.monotonic() + gap
+
+        __send_burst(burst)
+
+        if skipped > 0:
+            print(" INFO: Skipped " + str(skipped) + " redundant commands")
 
     finally:
-        __close_serial()
+        if not keep_open:
+            __close_serial()
 
 
 
 
-def __init_serial():
+def __send_burst(burst):
 
-    global ser
-    dev = None
-    if port == None:
-        c = 0
-        for p in list(serial.tools.list_ports.comports()):
-            c += 1
-            dev = p.device
-            print(" INFO: Serial device found <" + p.device + ">")
+    # one break and one drain for all frames of burst
+    for cmd in burst:
+        __record(cmd)
 
-        if dev == None:
-            raise HelpException(" FATAL: No serial device found!")
+    frames = [ cmd["frame"] for cmd in burst if cmd["frame"] != None ]
+    if len(frames) > 0:
+        __send_frames(frames)
 
-        elif c > 1:
-            raise HelpException("""
- FATAL: Found more than one serial device
- Please force serial device by (a) passing it as parameter, e.g.
- $ denon.sh /dev/ttyUSB0 ...
- or (b) by settings PORT constant inside program code, e.g.
- PORT = "/dev/ttyUSB0"
-                """)
-    else:
-        print(" INFO: Force serial device to <" + port + ">")
-        dev = port
+    for cmd in burst:
+        print(" DONE: <" + cmd["rc_cmd"] + ">")
 
-    ser = serial.Serial(dev, baudrate = 115200, 
-                        bytesize = serial.EIGHTBITS,
-                        parity = serial.PARITY_NONE, 
-                        stopbits = serial.STOPBITS_ONE, 
-                        timeout = 5, 
-                        write_timeout = 5,
-                        rtscts = True, 
-                        dsrdtr = True,
-                        xonxoff = False,
-                        exclusive = True)
+    burst.clear()
 
 
 
 
-def __close_serial():
+def __send_and_wait_for_ack(cmd):
 
-    global ser
+    # drop status frames that have been received before
+    while not status_frames.empty():
+        status_frames.get_nowait()
 
-    if ser != None:
-        ser.close()
+    timeout = PACING[pacing_class(cmd["cmd"])]
+    opcode = cmd["frame"][5]
 
+    start = time.monotonic()
+    __record(cmd)
+    __send_package(cmd["frame"])
 
+    # command is done as soon as receiver replies with same opcode
+    elapsed = 0
+    while elapsed < timeout:
+        try:
+            frame = status_frames.get(timeout = timeout - elapsed)
+        except queue.Empty:
+            break
 
+        elapsed = time.monotonic() - start
+        if len(frame.data) > 0 and frame.data[0] == opcode:
+            pacing_feedback(cmd["cmd"], elapsed)
+            observe_metric("denon_ack_seconds", elapsed)
+            return 0
 
-def __build_package(data):
+    print(" WARN: No acknowledgement for <" + cmd["rc_cmd"] + ">")
+    count_metric("denon_ack_timeouts_total", cmd = cmd["cmd"])
+    pacing_feedback(cmd["cmd"], None)
 
-    # preample
-    package = [ 255, 85 ]
+    return max(0, timeout - (time.monotonic() - start))
 
-    # length
-    length = len(data) - 2
-    package += [ length ]
 
-    # static
-    package += [ 1, 0 ]
 
-    # data
-    package += data
 
-    # checksum
-    checksum = 0
-    for i in package:
-        checksum += i
+def new_receiver():
 
-    checksum %= 256
-    package += [ checksum ]
+    # separate known state of another receiver, e.g. for AsyncDenon
+    return {
+        "state" : {},
+        "entry" : {
+            "tens" : 0,
+            "enters" : 0,
+            "cleared" : False,
+            "menu" : False
+            },
+        "saturation" : {}
+        }
 
-    return package
 
 
 
+def is_redundant(cmd, receiver = None):
 
-def __send_package(package):
+    args = cmd["rc_cmd"].split()[1:]
+    kind, value = __state_of(cmd["cmd"], args[0] if len(args) > 0 else None)
+    known = (receiver or __receiver)["state"]
 
-    global ser
-    ser.sendBreak()
-    ser.write(package)
-    ser.flush()
+    # receiver may ignore commands in standby
+    return (kind in __STATE_KINDS and kind in known and known[kind] == value
+            and (kind == "power" or known.get("power") != "off"))
 
 
 
 
-def __number_to_rc_commands(no):
+def track_command(cmd, receiver = None):
 
-    no = int(no)
+    name = cmd["cmd"]
+    args = cmd["rc_cmd"].split()[1:]
+    receiver = receiver or __receiver
+    known = receiver["state"]
+    entry = receiver["entry"]
 
-    rc_commands = []
-    while True:
-        if no >= 10:
-            rc_commands += ["num", "+10"]
-            no -= 10
-        else:
-            rc_commands += ["num", str(no)]
-            break
+    kind, value = __state_of(name, args[0] if len(args) > 0 else None)
 
-    return rc_commands
+    # receiver ignores everything but power on in standby
+    if known.get("power") == "off" and kind != "power":
+        return
 
+    if kind in __STATE_KINDS:
+        known[kind] = value
 
+    if name in LEVELS:
+        __track_level(name, __STEPS[name][args[0]], receiver)
 
+    elif name == "on":
+        # source after power on isn't reliable, so it is set again if needed
+        known.pop("source", None)
+        known.pop("preset", None)
 
-def build_macro(macro_call):
+    elif name == "num" and not entry["menu"]:
+        entry["enters"] = 0
+        entry["cleared"] = False
+        if args[0] == "+10":
+            entry["tens"] += 10
+        else:
+            # digits select tracks of other sources
+            if known.get("source") == "fm":
+                known["preset"] = entry["tens"] + int(args[0])
+            entry["tens"] = 0
+
+    elif name == "preset" and known.get("preset") != None:
+        known["preset"] += 1 if args[0] == "+" else -1
+        if known["preset"] not in range(1, PRESETS + 1):
+            known.pop("preset")
+
+    elif name == "clear" and not entry["menu"]:
+        entry["cleared"] = True
+        entry["enters"] = 0
+
+    elif name == "enter":
+        # enter, enter opens menu for preset name, clear, enter deletes preset
+        if entry["menu"]:
+            entry["menu"] = False
+        elif entry["cleared"]:
+            entry["cleared"] = False
+        else:
+            entry["enters"] += 1
+            if entry["enters"] == 2:
+                entry["enters"] = 0
+                entry["menu"] = True
 
-    if len(macro_call) == 0:
-        raise HelpException(" ERROR: No macro name given.")
 
-    macro_cmd = macro_call.pop(0)
 
-    if macro_cmd == "preset":
-        rc_commands = __build_macro_preset(macro_call)
 
-    elif macro_cmd == "delete-preset":
-        rc_commands = __build_macro_delete_presets(macro_call)
+def __track_level(name, step, receiver):
 
-    elif macro_cmd == "set-preset-name":
-        rc_commands = __build_macro_set_preset_name(macro_call)
+    known = receiver["state"]
+    saturation = receiver["saturation"]
 
-    else:
-        raise HelpException(" ERROR: Macro <" + macro_cmd + "> unknown.")
+    if name in known:
+        known[name] = __step_level(name, known[name], step)
+        return
 
-    return rc_commands
+    # level becomes known after enough steps in same direction
+    steps = saturation.get(name, 0)
+    steps = steps + step if steps * step >= 0 else step
+    saturation[name] = steps
 
+    if abs(steps) >= len(LEVELS[name]) - 1:
+        known[name] = LEVELS[name][0] if steps < 0 else LEVELS[name][-1]
+        saturation.pop(name)
 
 
 
-def __build_macro_delete_presets(macro_call):
 
-    # validate parameters
-    try:
-        if len(macro_call) == 0:
-            raise Exception()
+def pacing_class(cmd):
 
-        start = int(macro_call.pop(0))
-        end = start
-        if len(macro_call) > 0:
-            end = int(macro_call.pop(0))
-    except:
-        raise HelpException(__build_help(COMMANDS["macro delete-preset"], True,
-                   "ERROR: Invalid parameters."))
+    for cls in __PACING_CLASSES:
+        if cmd in __PACING_CLASSES[cls]:
+            return cls
 
-    # build rc commands
-    rc_commands = ["fm"]
-    while start <= end:
-        rc_commands += __number_to_rc_commands(start)
-        rc_commands += ["clear", "enter"]
-        start += 1
+    return "default"
 
-    return rc_commands
 
 
 
+def pacing_gap(cmd):
 
-def __build_macro_preset(macro_call):
+    cls = pacing_class(cmd)
+    if cls in __pacing:
+        return __pacing[cls]
 
-    # validate parameters
-    try:
-        if len(macro_call) == 0:
-            raise Exception()
+    return PACING[cls]
 
-        preset = int(macro_call.pop(0))
 
-    except:
-        raise HelpException(__build_help(COMMANDS["macro preset"], True,
-                   "ERROR: Invalid parameters."))
 
-    # build rc commands
-    rc_commands = ["fm", "wait"]
-    rc_commands += __number_to_rc_commands(preset)
 
-    return rc_commands
+def pacing_feedback(cmd, elapsed):
 
+    # tighten gap of command class from measured response time of receiver,
+    # or fall back to configured gap if receiver hasn't responded (None)
+    cls = pacing_class(cmd)
+    if elapsed == None:
+        __pacing.pop(cls, None)
+        return
 
+    gap = pacing_gap(cmd)
+    gap = min(PACING[cls], max(PACING_MIN, (gap + elapsed * 2) / 2))
+    __pacing[cls] = gap
 
 
-def __build_macro_set_preset_name(macro_call):
 
-    # validate parameters
-    try:
-        if len(macro_call) < 2:
-            raise Exception()
 
-        preset = int(macro_call.pop(0))
-        name = macro_call.pop(0) + (" " * 8)
-        name = name.upper()[:8]
+def count_metric(name, value = 1, **labels):
 
-    except:
-        raise HelpException(__build_help(COMMANDS["macro set-preset-name"], True,
-                   "ERROR: Invalid parameters."))
+    key = (name, __metric_labels(labels))
+    with __metrics_lock:
+        __counters[key] = __counters.get(key, 0) + value
 
-    # build rc commands
-    rc_commands = ["fm"]
-    rc_commands += __number_to_rc_commands(preset)
-    rc_commands += ["enter", "enter"]
 
-    i = 0
-    for c in name:
-        i += 1
-        press = None
-        key = None
-        for p in range(len(KEY_PAD)):
-            if c in KEY_PAD[p]:
-                key = p
-                press = KEY_PAD[p].index(c) + 1
-
-        if key == None:
-            key = 0
-            press = 2
 
-        rc_commands += ["clear"]
-        if i > 1:
-            rc_commands += ["right"]
-        rc_commands += __number_to_rc_commands(key) * press
-        rc_commands += ["right"]
-    rc_commands += ["enter"]
 
-    return rc_commands
+def observe_metric(name, seconds, **labels):
 
+    # cumulative counts per bucket, followed by count and sum
+    key = (name, __metric_labels(labels))
+    with __metrics_lock:
+        if key not in __histograms:
+            __histograms[key] = [ 0 ] * (len(METRICS_BUCKETS) + 1) + [ 0 ]
 
+        h = __histograms[key]
+        for i in range(len(METRICS_BUCKETS)):
+            if seconds <= METRICS_BUCKETS[i]:
+                h[i] += 1
 
+        h[-2] += 1
+        h[-1] += seconds
 
-def sendto_denon(commands):
 
-    global port
 
-    if len(commands) > 0 and commands[0].startswith("/dev/tty"):
-        port = commands.pop(0)
 
-    if commands[0] == "macro":
-        commands = build_macro(commands[1:])
+def __metric_labels(labels):
 
-    binary_commands = build_binary_commands_from_rc(commands)
-    send_serial_commands(binary_commands)
+    return ",".join([ k + "=\"" + str(labels[k]).replace("\\", "\\\\")
+                      .replace("\"", "\\\"") + "\"" for k in sorted(labels) ])
 
 
 
 
-if __name__ == "__main__":
+def __metric_sample(name, labels, value, extra = ""):
+
+    labels = ",".join([ l for l in (labels, extra) if l != "" ])
+    if labels != "":
+        name += "{" + labels + "}"
+
+    return name + " " + str(value)
+
+
+
+
+def metrics_text():
+
+    # Prometheus text format
+    lines = []
+    with __metrics_lock:
+        typed = None
+        for name, labels in sorted(__counters):
+            if name != typed:
+                lines.append("# TYPE " + name + " counter")
+                typed = name
+
+            lines.append(__metric_sample(name, labels,
+                                         __counters[(name, labels)]))
+
+        for name, labels in sorted(__histograms):
+            if name != typed:
+                lines.append("# TYPE " + name + " histogram")
+                typed = name
+
+            h = __histograms[(name, labels)]
+            for i in range(len(METRICS_BUCKETS)):
+                lines.append(__metric_sample(name + "_bucket", labels, h[i],
+                             "le=\"" + str(METRICS_BUCKETS[i]) + "\""))
+
+            lines.append(__metric_sample(name + "_bucket", labels, h[-2],
+                                         "le=\"+Inf\""))
+            lines.append(__metric_sample(name + "_sum", labels, h[-1]))
+            lines.append(__metric_sample(name + "_count", labels, h[-2]))
+
+    return "\n".join(lines) + "\n"
+
+
+
+
+def write_metrics(path):
+
+    # replace file at once so that collectors never read half a file
+    try:
+        with open(path + ".tmp", "w") as f:
+            f.write(metrics_text())
+
+        os.replace(path + ".tmp", path)
+
+    except OSError as e:
+        print(" WARN: Can't write metrics to <" + path + ">: " + e.strerror)
+
+
+
+
+def __sleep(seconds):
+
+    if seconds > 0:
+        start = time.monotonic()
+        time.sleep(seconds)
+        count_metric("denon_sleep_seconds_total", time.monotonic() - start)
+
+
+
+
+def load_config():
+
+    global config_loaded, BREAK, BREAK_DURATION
+
+    if config_loaded:
+        return
+
+    import configparser
+
+    config = configparser.ConfigParser()
+    try:
+        config.read(CONFIG)
+
+        if config.has_section("pacing"):
+            for cls in config.options("pacing"):
+                if cls not in PACING:
+                    raise ValueError("unknown pacing class <" + cls + ">")
+                PACING[cls] = config.getfloat("pacing", cls)
+
+        if config.has_section("ports"):
+            for name in config.options("ports"):
+                PORTS[name] = config.get("ports", name)
+
+        for section in config.sections():
+            if section.startswith("scene "):
+                SCENES[section[6:].strip()] = dict(config.items(section))
+
+        if config.has_option("serial", "break"):
+            BREAK = config.get("serial", "break")
+            if BREAK not in BREAK_MODES:
+                raise ValueError("unknown break <" + BREAK + ">")
+
+        if config.has_option("serial", "break_duration"):
+            BREAK_DURATION = config.getfloat("serial", "break_duration")
+
+    except (configparser.Error, ValueError) as e:
+        raise HelpException(" ERROR: Invalid config file <" + CONFIG
+                            + ">: " + str(e))
+
+    config_loaded = True
+
+
+
+
+def __init_serial():
+
+    global ser
+
+    dev = find_port()
+    try:
+        ser = open_serial(dev)
+
+    except serial.SerialException as e:
+        if port != None or e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+
+        # cached device may belong to another adapter meanwhile
+        __uncache_port()
+        rescanned = find_port()
+        if rescanned == dev:
+            raise
+
+        ser = open_serial(rescanned)
+
+    if READ_STATUS:
+        start_reader()
+
+
+
+
+def find_port(verbose = True):
+
+    if port != None:
+        if verbose:
+            print(" INFO: Force serial device to <" + port + ">")
+        return port
+
+    dev = __cached_port()
+    if dev != None:
+        if verbose:
+            print(" INFO: Serial device <" + dev + "> from cache")
+        return dev
+
+    __import_serial()
+    ports = list(serial.tools.list_ports.comports())
+    for p in ports:
+        if verbose:
+            print(" INFO: Serial device found <" + p.device + ">")
+
+    # prefer known USB adapters over other serial devices
+    adapters = [ p for p in ports
+                 if __is_adapter(p.vid, p.pid, p.serial_number) ]
+    if len(adapters) > 0:
+        ports = adapters
+
+    if len(ports) == 0:
+        raise HelpException(" FATAL: No serial device found!")
+
+    elif len(ports) > 1:
+        raise HelpException("""
+ FATAL: Found more than one serial device
+ Please force serial device by (a) passing it as parameter, e.g.
+ $ denon.sh /dev/ttyUSB0 ...
+ or (b) by settings PORT constant inside program code, e.g.
+ PORT = "/dev/ttyUSB0"
+ or (c) by adding serial number of adapter to ADAPTERS constant, e.g.
+ ADAPTERS = [ (0x067b, 0x2303, "A1B2C3") ]
+                """)
+
+    dev = ports[0].device
+    __cache_port(dev, ports[0])
+
+    return dev
+
+
+
+
+def __is_adapter(vid, pid, serial_number):
+
+    for a_vid, a_pid, a_serial_number in ADAPTERS:
+        if vid == a_vid and pid == a_pid and (a_serial_number == None
+                                              or serial_number == a_serial_number):
+            return True
+
+    return False
+
+
+
+
+def __usb_ids(dev):
+
+    # vid, pid and serial number of USB adapter behind tty device, sysfs is
+    # read instead of scanning all tty devices
+    name = os.path.basename(os.path.realpath(dev))
+    path = os.path.realpath("/sys/class/tty/" + name + "/device")
+
+    # e.g. interface of ttyACM or port below interface of ttyUSB
+    for i in range(3):
+        try:
+            with open(os.path.join(path, "idVendor")) as f:
+                vid = int(f.read(), 16)
+            with open(os.path.join(path, "idProduct")) as f:
+                pid = int(f.read(), 16)
+        except (OSError, ValueError):
+            path = os.path.dirname(path)
+            continue
+
+        try:
+            with open(os.path.join(path, "serial")) as f:
+                serial_number = f.read().strip()
+        except OSError:
+            serial_number = None
+
+        return vid, pid, serial_number
+
+    return None, None, None
+
+
+
+
+def __cached_port():
+
+    # stat is much cheaper than scanning all tty devices
+    try:
+        with open(PORT_CACHE) as f:
+            cache = json.load(f)
+
+        if os.stat(cache["device"]).st_rdev != cache["rdev"]:
+            return None
+
+        # device name is kept if another adapter is plugged in instead
+        if cache["vid"] != None:
+            if __usb_ids(cache["device"]) != (cache["vid"], cache["pid"],
+                                               cache["serial_number"]):
+                return None
+
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+    return cache["device"]
+
+
+
+
+def __cache_port(dev, p):
+
+    try:
+        cache = { "device" : dev, "rdev" : os.stat(dev).st_rdev,
+                  "vid" : p.vid, "pid" : p.pid,
+                  "serial_number" : p.serial_number }
+        os.makedirs(os.path.dirname(PORT_CACHE), exist_ok = True)
+        with open(PORT_CACHE, "w") as f:
+            json.dump(cache, f)
+
+    except OSError:
+        pass
+
+
+
+
+def __uncache_port():
+
+    try:
+        os.unlink(PORT_CACHE)
+    except OSError:
+        pass
+
+
+
+
+def __import_serial():
+
+    global serial
+
+    # pyserial is slow to import, so it is imported as late as possible,
+    # e.g. not at all if help is shown or command is invalid
+    import serial.tools.list_ports
+
+
+
+
+def open_serial(dev):
+
+    __import_serial()
+
+    delay = OPEN_BACKOFF
+    retries = OPEN_RETRIES
+    while True:
+        start = time.monotonic()
+        try:
+            s = serial.Serial(dev, baudrate = 115200,
+                              bytesize = serial.EIGHTBITS,
+                              parity = serial.PARITY_NONE,
+                              stopbits = serial.STOPBITS_ONE,
+                              timeout = 5,
+                              write_timeout = WRITE_TIMEOUT,
+                              rtscts = True,
+                              dsrdtr = True,
+                              xonxoff = False,
+                              exclusive = True)
+
+            observe_metric("denon_open_seconds", time.monotonic() - start)
+            count_metric("denon_opens_total", port = dev)
+            return s
+
+        except serial.SerialException as e:
+            count_metric("denon_open_failures_total", port = dev)
+
+            # port is held exclusively by another process
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK) or retries == 0:
+                raise
+
+        print(" WARN: Serial device <" + dev + "> is locked, retry in "
+              + str(delay) + " seconds")
+        time.sleep(delay)
+        delay *= 2
+        retries -= 1
+
+
+
+
+def __close_serial():
+
+    global ser, reader
+
+    if ser != None:
+        if reader != None:
+            ser.cancel_read()
+
+        # port may have died already
+        try:
+            ser.close()
+        except (OSError, termios.error):
+            pass
+
+        if reader != None:
+            reader.join()
+            reader = None
+
+        ser = None
+
+
+
+
+def __build_package(data):
+
+    # preample
+    package = [ 255, 85 ]
+
+    # length
+    length = len(data) - 2
+    package += [ length ]
+
+    # static
+    package += [ 1, 0 ]
+
+    # data
+    package += data
+
+    # checksum
+    checksum = 0
+    for i in package:
+        checksum += i
+
+    checksum %= 256
+    package += [ checksum ]
+
+    return bytes(package)
+
+
+
+
+def __send_package(package, s = None):
+
+    if s != None:
+        __write_frames(s, [ package ])
+        return
+
+    __send_frames([ package ])
+
+
+
+
+def __send_frames(frames):
+
+    # sending continues on reopened port with first frame that hasn't been
+    # written if port has died, the break before lets the receiver drop
+    # parts of that frame
+    frames = list(frames)
+    deadline = None
+    while True:
+        try:
+            __write_frames(ser, frames)
+            return
+
+        except (serial.SerialException, OSError, termios.error) as e:
+            if deadline == None:
+                deadline = time.monotonic() + RECONNECT_TIMEOUT
+            print(" WARN: Serial port has failed: " + str(e))
+            __reconnect(deadline)
+
+
+
+
+def __write_frames(s, frames):
+
+    # frames that have been written are removed from list
+    start = time.monotonic()
+    if BREAK != "none":
+        s.sendBreak(BREAK_DURATION)
+
+    written = time.monotonic()
+    size = 0
+    while len(frames) > 0:
+        s.write(frames[0])
+        size += len(frames.pop(0))
+
+    flushed = time.monotonic()
+    s.flush()
+
+    end = time.monotonic()
+    observe_metric("denon_write_seconds", flushed - written)
+    observe_metric("denon_flush_seconds", end - flushed)
+    count_metric("denon_break_seconds_total", written - start)
+    count_metric("denon_io_seconds_total", end - start)
+    count_metric("denon_bytes_written_total", size, port = s.port)
+
+
+
+
+def __reconnect(deadline):
+
+    global ser
+
+    restart_reader = reader != None
+    __close_serial()
+    count_metric("denon_reconnects_total")
+
+    # device may come back with another name, e.g. /dev/ttyUSB1
+    start = time.monotonic()
+    while True:
+        try:
+            dev = find_port(verbose = False)
+            if os.path.exists(dev):
+                ser = open_serial(dev)
+                break
+
+        except (HelpException, serial.SerialException):
+            if time.monotonic() > deadline:
+                raise
+
+        if time.monotonic() > deadline:
+            raise serial.SerialException("Serial device is gone")
+
+        time.sleep(RECONNECT_INTERVAL)
+
+    if restart_reader:
+        start_reader()
+
+    print(" INFO: Reconnected to <" + dev + "> after "
+          + str(round(time.monotonic() - start, 2)) + " seconds")
+
+
+
+
+StatusFrame = collections.namedtuple("StatusFrame", ["kind", "value", "data"])
+
+
+
+
+class FrameDecoder:
+
+    def __init__(self):
+
+        self.buf = bytearray()
+        self.frames = 0
+        self.errors = 0
+
+    def feed(self, data):
+
+        # frames look like those that are sent, i.e. preamble FF 55, length,
+        # 2 static bytes, payload of length + 2 bytes and checksum
+        buf = self.buf
+        buf += data
+        pos = 0
+        frames = []
+
+        while True:
+            start = buf.find(b"\xff\x55", pos)
+            if start < 0:
+                # keep last byte since it may be start of next preamble
+                pos = max(pos, len(buf) - 1)
+                break
+
+            if len(buf) - start < 3:
+                pos = start
+                break
+
+            if buf[start + 2] > MAX_FRAME_LENGTH:
+                # corrupted length, don't wait for bytes that never come
+                self.errors += 1
+                pos = start + 1
+                continue
+
+            end = start + buf[start + 2] + 7
+            if end >= len(buf):
+                # wait for rest of frame
+                pos = start
+                break
+
+            if sum(buf[start:end]) % 256 != buf[end]:
+                # garbage or corrupted frame, resync behind preamble
+                self.errors += 1
+                pos = start + 1
+                continue
+
+            self.frames += 1
+            pos = end + 1
+            frames.append(status_frame(bytes(buf[start + 5:end])))
+
+        # drop consumed bytes in place
+        del buf[:pos]
+
+        return frames
+
+
+
+
+def status_frame(payload):
+
+    global __payloads
+
+    if __payloads == None:
+        __payloads = {}
+        for cmd in COMMANDS:
+            frames = __frame_table(cmd)
+            for param in frames:
+                __payloads.setdefault(frames[param][5:-1], (cmd, param))
+
+    if payload not in __payloads:
+        return StatusFrame("unknown", None, payload)
+
+    cmd, param = __payloads[payload]
+    kind, value = __state_of(cmd, param)
+
+    return StatusFrame(kind, value, payload)
+
+
+
+
+def __state_of(cmd, param):
+
+    kind = __STATUS_KINDS.get(cmd, cmd)
+
+    if kind == "power":
+        value = cmd
+    elif kind == "source":
+        value = cmd if param == None else cmd + " " + param
+    elif param != None and param.isdigit():
+        value = int(param)
+    else:
+        value = param
+
+    return kind, value
+
+
+
+
+def track_status(frame, receiver = None):
+
+    if frame.kind in __STATE_KINDS:
+        (receiver or __receiver)["state"][frame.kind] = frame.value
+
+
+
+
+def __read_serial(s):
+
+    decoder = FrameDecoder()
+    try:
+        while s.is_open:
+            data = s.read(max(1, s.in_waiting))
+            for frame in decoder.feed(data):
+                track_status(frame)
+                status_frames.put(frame)
+
+    except (serial.SerialException, OSError, TypeError):
+        # port has been closed
+        pass
+
+
+
+
+def start_reader():
+
+    global reader
+
+    reader = threading.Thread(target = __read_serial, args = (ser,),
+                              daemon = True)
+    reader.start()
+
+
+
+
+def listen():
+
+    if keep_open:
+        raise HelpException(" ERROR: Command <listen> is not available"
+                            + " in daemon mode.")
+
+    try:
+        if ser == None:
+            __init_serial()
+
+        if reader == None:
+            start_reader()
+
+        print(" INFO: Listening for status of receiver")
+        while True:
+            frame = status_frames.get()
+            print(" STATUS: " + frame.kind + " <" + str(frame.value) + "> "
+                  + frame.data.hex(" "))
+
+    finally:
+        if not keep_open:
+            __close_serial()
+
+
+
+
+def __number_to_rc_commands(no):
+
+    no = int(no)
+
+    rc_commands = []
+    while True:
+        if no >= 10:
+            rc_commands += ["num", "+10"]
+            no -= 10
+        else:
+            rc_commands += ["num", str(no)]
+            break
+
+    return rc_commands
+
+
+
+
+def build_macro(macro_call, receiver = None):
+
+    rc_commands = []
+    for segment in build_macro_segments(macro_call, receiver):
+        rc_commands += segment
+
+    return rc_commands
+
+
+
+
+def build_macro_segments(macro_call, receiver = None):
+
+    # segments of macro must be sent completely, commands of other
+    # clients may be sent between segments in daemon mode
+    if len(macro_call) == 0:
+        raise HelpException(" ERROR: No macro name given.",
+                            "invalid-macro")
+
+    macro_cmd = macro_call.pop(0)
+
+    if macro_cmd == "preset":
+        segments = [ __build_macro_preset(macro_call, receiver) ]
+
+    elif macro_cmd == "delete-preset":
+        segments = __build_macro_delete_presets(macro_call, receiver)
+
+    elif macro_cmd == "set-preset-name":
+        segments = [ __build_macro_set_preset_name(macro_call, receiver) ]
+
+    else:
+        raise HelpException(" ERROR: Macro <" + macro_cmd + "> unknown.",
+                            "invalid-macro", macro = macro_cmd)
+
+    return segments
+
+
+
+
+def __build_macro_delete_presets(macro_call, receiver):
+
+    # validate parameters
+    try:
+        if len(macro_call) == 0:
+            raise Exception()
+
+        start = int(macro_call.pop(0))
+        end = start
+        if len(macro_call) > 0:
+            end = int(macro_call.pop(0))
+    except:
+        raise HelpException(__build_help(COMMANDS["macro delete-preset"], True,
+                   "ERROR: Invalid parameters."),
+                   "invalid-parameters",
+                   usage = COMMANDS["macro delete-preset"][__USAGE])
+
+    return __delete_preset_segments(start, end, receiver)
+
+
+
+
+def __delete_preset_segments(start, end, receiver):
+
+    # build rc commands, FM is selected again if source has been changed
+    # between segments
+    known = (receiver or __receiver)["state"]
+    source = None
+    while start <= end:
+        rc_commands = []
+        if source == None or known.get("source") != "fm":
+            rc_commands += ["fm"]
+            source = "fm"
+
+        rc_commands += __number_to_rc_commands(start)
+        rc_commands += ["clear", "enter"]
+        start += 1
+
+        yield rc_commands
+
+
+
+
+def __build_macro_preset(macro_call, receiver = None):
+
+    # validate parameters
+    try:
+        if len(macro_call) == 0:
+            raise Exception()
+
+        preset = int(macro_call.pop(0))
+
+    except:
+        raise HelpException(__build_help(COMMANDS["macro preset"], True,
+                   "ERROR: Invalid parameters."),
+                   "invalid-parameters",
+                   usage = COMMANDS["macro preset"][__USAGE])
+
+    # build rc commands
+    rc_commands = []
+    if (receiver or __receiver)["state"].get("source") != "fm":
+        # tuner needs some time after switching source
+        rc_commands += ["fm", "wait"]
+
+    rc_commands += __plan_preset(preset, receiver)
+
+    return rc_commands
+
+
+
+
+def __plan_preset(preset, receiver = None):
+
+    # entering digits always works
+    plan = __number_to_rc_commands(preset)
+
+    # zap from current preset or from preset that is reached by digits
+    starts = [ (m, __number_to_rc_commands(m))
+               for m in range(1, min(preset + 10, PRESETS + 1)) ]
+    known = (receiver or __receiver)["state"]
+    if known.get("preset") != None:
+        starts.insert(0, (known["preset"], []))
+
+    for start, rc_commands in starts:
+        steps = preset - start
+        rc_commands = rc_commands + (["preset", "+" if steps > 0 else "-"]
+                                     * abs(steps))
+        if len(rc_commands) < len(plan):
+            plan = rc_commands
+
+    return plan
+
+
+
+
+def __build_macro_set_preset_name(macro_call, receiver):
+
+    # validate parameters
+    try:
+        if len(macro_call) < 2:
+            raise Exception()
+
+        preset = int(macro_call.pop(0))
+        name = macro_call.pop(0)
+        previous = None
+        if len(macro_call) > 0:
+            previous = macro_call.pop(0)
+
+    except:
+        raise HelpException(__build_help(COMMANDS["macro set-preset-name"], True,
+                   "ERROR: Invalid parameters."),
+                   "invalid-parameters",
+                   usage = COMMANDS["macro set-preset-name"][__USAGE])
+
+    # build rc commands
+    rc_commands = []
+    if (receiver or __receiver)["state"].get("source") != "fm":
+        rc_commands += ["fm"]
+
+    rc_commands += __plan_preset(preset, receiver)
+    rc_commands += ["enter", "enter"]
+    rc_commands += __plan_preset_name(name, previous)
+    rc_commands += ["enter"]
+
+    return rc_commands
+
+
+
+
+def __plan_preset_name(name, previous = None):
+
+    name = name.upper().ljust(NAME_LENGTH)[:NAME_LENGTH]
+
+    # positions that must be typed, all if previous name is unknown
+    if previous == None:
+        changes = list(range(NAME_LENGTH))
+    else:
+        previous = previous.upper().ljust(NAME_LENGTH)[:NAME_LENGTH]
+        changes = [ i for i in range(NAME_LENGTH) if name[i] != previous[i] ]
+
+    rc_commands = []
+    if len(changes) == 0:
+        return rc_commands
+
+    # clear blanks char at cursor like backspace, so right is required to get
+    # back. Blanks need no key presses and cursor isn't moved behind last
+    # changed char
+    for i in range(changes[-1] + 1):
+        if i > 0:
+            rc_commands += ["right"]
+
+        if i not in changes:
+            continue
+
+        rc_commands += ["clear"]
+        if i > 0:
+            rc_commands += ["right"]
+
+        if name[i] != " ":
+            key, press = __KEY_INDEX.get(name[i], __KEY_INDEX[" "])
+            rc_commands += ["num", str(key)] * press
+
+    return rc_commands
+
+
+
+
+def __parse_options(commands, options = None):
+
+    if options == None:
+        options = {
+            "ack" : ACK,
+            "elide" : ELIDE,
+            "coalesce" : COALESCE,
+            "reset_levels" : RESET_LEVELS,
+            "deadline" : DEADLINE,
+            "port" : None,
+            "group" : None,
+            "sync" : False,
+            "metrics" : METRICS,
+            "record" : None,
+            "http" : None
+            }
+
+    while len(commands) > 0 and commands[0].startswith("--"):
+        option = commands.pop(0)
+        if option == "--ack":
+            options["ack"] = True
+        elif option == "--no-coalesce":
+            options["coalesce"] = False
+        elif option == "--reset-levels":
+            options["reset_levels"] = True
+        elif option == "--elide":
+            options["elide"] = True
+        elif option == "--deadline" and len(commands) > 0:
+            try:
+                options["deadline"] = float(commands.pop(0))
+            except ValueError:
+                raise HelpException(" ERROR: Invalid deadline.")
+        elif option == "--group" and len(commands) > 0:
+            options["group"] = commands.pop(0).split(",")
+        elif option == "--sync":
+            options["sync"] = True
+        elif option == "--metrics" and len(commands) > 0:
+            options["metrics"] = commands.pop(0)
+        elif option == "--record" and len(commands) > 0:
+            options["record"] = commands.pop(0)
+        elif option == "--http" and len(commands) > 0:
+            options["http"] = commands.pop(0)
+        else:
+            raise HelpException(" ERROR: Option <" + option + "> unknown.")
+
+    return options
+
+
+
+
+def __prepare(commands):
+
+    load_config()
+    options = __parse_options(commands)
+
+    if len(commands) > 0 and commands[0].startswith("/"):
+        options["port"] = commands.pop(0)
+
+    # options may also follow port
+    __parse_options(commands, options)
+
+    if options["http"] != None:
+        raise HelpException(" ERROR: Option --http is only supported in"
+                            + " daemon mode.")
+
+    if len(commands) == 0:
+        raise HelpException(__help() + "\n\n ERROR: No command given.\n")
+
+    # levels of scenes are absolute
+    if commands[0] == "scene":
+        options["reset_levels"] = True
+
+    return options
+
+
+
+
+def __select_port(dev):
+
+    global port
+
+    if dev != None and dev != port:
+        __close_serial()
+        port = dev
+
+
+
+
+def sendto_denon(commands):
+
+    options = __prepare(commands)
+    __select_port(options["port"])
+
+    if commands == ["listen"]:
+        listen()
+        return
+
+    if options["group"] != None:
+        if options["record"] != None:
+            raise HelpException(" ERROR: Option --record is not supported"
+                                + " with --group.")
+        try:
+            __send_group(options["group"], commands, options)
+        finally:
+            if options["metrics"] != None:
+                write_metrics(options["metrics"])
+        return
+
+    if commands[0] == "replay":
+        binary_commands = read_capture(commands[1:2])
+    else:
+        binary_commands = __segment_commands(__segments(commands), options)
+
+    # commands are validated before port is opened, scripts are parsed
+    # line by line while sending, scenes are planned step by step
+    if commands[0] == "scene":
+        __scene_plan(" ".join(commands[1:]))
+    elif commands[0] not in ("-", "-f"):
+        binary_commands = list(binary_commands)
+
+    if options["record"] != None:
+        start_recording(options["record"])
+
+    try:
+        if commands[0] == "replay":
+            replay(binary_commands, commands[2:])
+        else:
+            send_serial_commands(binary_commands, ack = options["ack"],
+                                 elide = options["elide"])
+    finally:
+        stop_recording()
+        if options["metrics"] != None:
+            write_metrics(options["metrics"])
+
+
+
+
+def __group_ports(group):
+
+    devices = []
+    for name in group:
+        if name.startswith("/"):
+            devices.append((name, name))
+        elif name in PORTS:
+            devices.append((name, PORTS[name]))
+        else:
+            raise HelpException(" ERROR: Receiver <" + name + "> unknown."
+                                + " Add it to section [ports] of <" + CONFIG
+                                + ">")
+
+    return devices
+
+
+
+
+def __send_group(group, commands, options):
+
+    devices = __group_ports(group)
+
+    # commands are built once and sent to all receivers concurrently
+    commands = list(__segment_commands(__segments(commands), options))
+
+    barrier = None
+    if options["sync"]:
+        barrier = threading.Barrier(len(devices))
+
+    start = time.monotonic()
+    results = []
+    workers = []
+    for name, dev in devices:
+        result = { "name" : name, "dev" : dev, "log" : [], "error" : None }
+        worker = threading.Thread(target = __group_worker,
+                                  args = (dev, commands, barrier, result))
+        worker.start()
+        results.append(result)
+        workers.append(worker)
+
+    for worker in workers:
+        worker.join()
+
+    failed = []
+    for result in results:
+        print(" INFO: Receiver <" + result["name"] + "> at <" + result["dev"]
+              + ">")
+        for line in result["log"]:
+            print(line)
+
+        if result["error"] != None:
+            print(" ERROR: <" + result["name"] + "> " + result["error"])
+            failed.append(result["name"])
+        else:
+            print(" DONE: <" + result["name"] + "> in "
+                  + str(round(result["seconds"], 2)) + " seconds")
+
+    print(" INFO: Sent to " + str(len(results) - len(failed)) + " of "
+          + str(len(results)) + " receivers in "
+          + str(round(time.monotonic() - start, 2)) + " seconds")
+
+    if len(failed) > 0:
+        raise HelpException(" ERROR: Failed to send to <" + ",".join(failed)
+                            + ">")
+
+
+
+
+def __group_worker(dev, commands, barrier, result):
+
+    # runs in thread per receiver, output is collected in result
+    start = time.monotonic()
+    s = None
+    try:
+        s = open_serial(dev)
+
+        gap = 0
+        for cmd in commands:
+            __sleep(gap)
+
+            # wait for other receivers so that sources change in sync
+            if barrier != None and pacing_class(cmd["cmd"]) == "source":
+                barrier.wait()
+
+            result["log"].append(" INFO: Send command <" + cmd["rc_cmd"]
+                                 + ">")
+            gap = pacing_gap(cmd["cmd"])
+            if cmd["frame"] != None:
+                __send_package(cmd["frame"], s)
+
+            count_metric("denon_commands_total", cmd = cmd["cmd"], port = dev)
+            result["log"].append(" DONE: <" + cmd["rc_cmd"] + ">")
+
+    except threading.BrokenBarrierError:
+        result["error"] = "Aborted since other receiver has failed"
+
+    except Exception as e:
+        # e.g. serial.SerialException or termios.error of break
+        result["error"] = str(e) or type(e).__name__
+
+    finally:
+        if result["error"] != None and barrier != None:
+            barrier.abort()
+
+        if s != None:
+            s.close()
+
+        result["seconds"] = time.monotonic() - start
+
+
+
+
+def __segments(commands):
+
+    # yields segments of rc commands with label for error messages
+    if commands[0] in ("-", "-f"):
+        yield from __script_segments(commands)
+
+    elif commands[0] == "macro":
+        for segment in build_macro_segments(commands[1:]):
+            yield None, segment
+
+    elif commands[0] == "scene":
+        name = " ".join(commands[1:])
+        for segment in __scene_steps(name, __scene_plan(name)):
+            yield None, segment
+
+    else:
+        yield None, commands
+
+
+
+
+def __scene_plan(name):
+
+    # scenes are validated and compiled once, steps are chosen when applied
+    if name in __scene_plans:
+        return __scene_plans[name]
+
+    if name not in SCENES:
+        raise HelpException(" ERROR: Scene <" + name + "> unknown.",
+                            "unknown-scene", scene = name)
+
+    settings = dict(SCENES[name])
+    for key in settings:
+        if key not in __SCENE_ORDER:
+            raise HelpException(" ERROR: Setting <" + key + "> of scene <"
+                                + name + "> unknown.", "invalid-scene",
+                                scene = name, setting = key)
+
+    # receiver is switched on unless scene switches it off, everything else
+    # is ignored in standby
+    if settings.setdefault("power", "on") == "off":
+        settings = { "power" : "off" }
+
+    plan = []
+    for key in [ key for key in __SCENE_ORDER if key in settings ]:
+        value = str(settings[key]).strip()
+        try:
+            if key == "preset":
+                if not value.isdigit() or int(value) not in range(1,
+                                                              PRESETS + 1):
+                    raise ValueError("Preset <" + value + "> is out of"
+                                     + " allowed range")
+                plan.append(("preset", int(value), None))
+                continue
+
+            rc_commands = shlex.split(value)
+            if key not in ("power", "source"):
+                rc_commands.insert(0, "vol" if key == "volume" else key)
+
+            build_binary_commands_from_rc(rc_commands, reset_levels = True)
+
+        except HelpException as e:
+            e.details.update(scene = name, setting = key)
+            raise HelpException(e.message + "\n ERROR: Setting <" + key
+                                + "> of scene <" + name + ">", e.error,
+                                **e.details)
+
+        except ValueError as e:
+            raise HelpException(" ERROR: Setting <" + key + "> of scene <"
+                                + name + ">: " + str(e), "invalid-scene",
+                                scene = name, setting = key)
+
+        kind, value = __state_of(rc_commands[0], (rc_commands + [None])[1])
+        if kind != key or len(rc_commands) > 2:
+            raise HelpException(" ERROR: Setting <" + key + "> of scene <"
+                                + name + "> is not a single " + key + ".",
+                                "invalid-scene", scene = name, setting = key)
+
+        if key in LEVELS:
+            value = int(rc_commands[1])
+
+        plan.append((kind, value, rc_commands))
+
+    __scene_plans[name] = plan
+
+    return plan
+
+
+
+
+def __scene_steps(name, plan):
+
+    # steps are chosen when they are reached so that known state includes
+    # previous steps, e.g. unknown source after power on
+    sent = 0
+    for kind, value, rc_commands in plan:
+        if kind == "preset":
+            if state.get("source") == "fm" and state.get("preset") == value:
+                continue
+            rc_commands = __build_macro_preset([ str(value) ])
+
+        elif state.get(kind) == value:
+            continue
+
+        sent += 1
+        yield rc_commands
+
+    print(" INFO: Scene <" + name + "> applied with " + str(sent) + " of "
+          + str(len(plan)) + " steps")
+
+
+
+
+def __segment_commands(segments, options):
+
+    # each segment is parsed when it is reached while sending
+    for label, rc_commands in segments:
+        try:
+            commands = build_binary_commands_from_rc(rc_commands,
+                                        reset_levels = options["reset_levels"])
+        except HelpException as e:
+            if label == None:
+                raise
+            raise HelpException(e.message + "\n ERROR: " + label)
+
+        if options["coalesce"]:
+            n = len(commands)
+            commands = coalesce_commands(commands)
+            if n > len(commands):
+                print(" INFO: Dropped " + str(n - len(commands))
+                      + " superseded commands")
+
+        yield from commands
+
+
+
+
+def start_recording(path):
+
+    global recording, __record_start
+
+    try:
+        recording = open(path, "wb")
+    except OSError as e:
+        raise HelpException(" ERROR: Can't write capture <" + path + ">: "
+                            + e.strerror)
+
+    recording.write(RECORD_MAGIC)
+    __record_start = time.monotonic()
+
+
+
+
+def stop_recording():
+
+    global recording
+
+    if recording != None:
+        recording.close()
+        recording = None
+
+
+
+
+def __record(cmd):
+
+    if recording == None:
+        return
+
+    frame = cmd["frame"] if cmd["frame"] != None else b""
+    rc_cmd = cmd["rc_cmd"].encode("utf-8")
+    recording.write(__RECORD.pack(time.monotonic() - __record_start,
+                                  len(frame), len(rc_cmd)) + frame + rc_cmd)
+
+
+
+
+def read_capture(args):
+
+    if len(args) == 0:
+        raise HelpException(__build_help(COMMANDS["replay"], True,
+                   "ERROR: Capture is missing:"))
+
+    try:
+        with open(args[0], "rb") as f:
+            data = f.read()
+    except OSError as e:
+        raise HelpException(" ERROR: Can't read capture <" + args[0] + ">: "
+                            + e.strerror)
+
+    if not data.startswith(RECORD_MAGIC):
+        raise HelpException(" ERROR: <" + args[0] + "> is not a capture.")
+
+    # commands with time of capture, frames are sent as they are
+    commands = []
+    i = len(RECORD_MAGIC)
+    while i < len(data):
+        try:
+            at, length, rc_length = __RECORD.unpack_from(data, i)
+        except struct.error:
+            raise HelpException(" ERROR: Capture <" + args[0]
+                                + "> is truncated.")
+
+        i += __RECORD.size
+        frame = data[i:i + length]
+        rc_cmd = data[i + length:i + length + rc_length].decode("utf-8",
+                                                                "replace")
+        i += length + rc_length
+        if len(frame) != length or i > len(data):
+            raise HelpException(" ERROR: Capture <" + args[0]
+                                + "> is truncated.")
+
+        commands.append({
+                "cmd" : rc_cmd.split(" ")[0],
+                "binary" : frame[5:-1] if length > 0 else "__WAIT__",
+                "frame" : frame if length > 0 else None,
+                "rc_cmd" : rc_cmd,
+                "at" : at
+            })
+
+    return commands
+
+
+
+
+def replay(commands, args):
+
+    global ready_at
+
+    if len(args) == 0:
+        factor = 1
+    elif args[0] == "fast":
+        factor = None
+    else:
+        try:
+            factor = float(args[0])
+            if factor <= 0:
+                raise ValueError()
+        except ValueError:
+            raise HelpException(__build_help(COMMANDS["replay"], True,
+                       "ERROR: Invalid factor <" + args[0] + ">:"))
+
+    # as fast as pacing allows
+    if factor == None:
+        send_serial_commands(commands)
+        return
+
+    try:
+        if ser == None:
+            __init_serial()
+
+        start = time.monotonic()
+        for cmd in commands:
+            __sleep(start + cmd["at"] / factor - time.monotonic())
+            print(" INFO: Send command <" + cmd["rc_cmd"] + ">")
+            __record(cmd)
+            if cmd["frame"] != None:
+                __send_package(cmd["frame"])
+
+            track_command(cmd)
+            count_metric("denon_commands_total", cmd = cmd["cmd"],
+                         port = ser.port)
+            print(" DONE: <" + cmd["rc_cmd"] + ">")
+
+        if len(commands) > 0:
+            ready_at = time.monotonic() + pacing_gap(commands[-1]["cmd"])
+
+    finally:
+        if not keep_open:
+            __close_serial()
+
+
+
+
+def __read_script(f):
+
+    n = 0
+    for line in f:
+        n += 1
+        try:
+            rc_commands = shlex.split(line, comments = True)
+        except ValueError as e:
+            raise HelpException(" ERROR: Line " + str(n) + " of script: "
+                                + str(e))
+
+        if len(rc_commands) > 0:
+            yield n, rc_commands
+
+
+
+
+def __script_segments(args):
+
+    if args == ["-"] and not keep_open:
+        f = sys.stdin
+
+    elif len(args) == 2 and args[0] == "-f":
+        try:
+            f = open(args[1])
+        except OSError as e:
+            raise HelpException(" ERROR: Can't read script <" + args[1]
+                                + ">: " + e.strerror)
+
+    else:
+        raise HelpException(" ERROR: Invalid parameters for script, use"
+                            + " -f <script> or - for stdin.")
+
+    try:
+        for n, rc_commands in __read_script(f):
+            label = "Line " + str(n) + " of script"
+            if rc_commands[0] != "macro":
+                yield label, rc_commands
+                continue
+
+            try:
+                segments = build_macro_segments(rc_commands[1:])
+            except HelpException as e:
+                raise HelpException(e.message + "\n ERROR: " + label)
+
+            for segment in segments:
+                yield label, segment
+
+    finally:
+        if f != sys.stdin:
+            f.close()
+
+
+
+
+class AsyncDenon:
+
+    def __init__(self, port = None, ack = ACK, elide = ELIDE,
+                 coalesce = COALESCE, on_status = None):
+
+        self.port = port
+        self.ack = ack
+        self.elide = elide
+        self.coalesce = coalesce
+        self.on_status = on_status
+
+        self.ser = None
+        self.fd = None
+        self.loop = None
+        self.lock = None
+        self.decoder = FrameDecoder()
+        self.waiters = []
+
+        # each receiver has its own known state
+        self.receiver = new_receiver()
+        self.state = self.receiver["state"]
+
+        # time when receiver is ready for next command
+        self.ready = 0
+
+    async def open(self):
+
+        global asyncio
+        import asyncio
+
+        self.loop = asyncio.get_running_loop()
+        self.lock = asyncio.Lock()
+
+        # scanning and retries of locked port block, so they run in executor
+        dev = self.port
+        if dev == None:
+            dev = await self.loop.run_in_executor(None, find_port)
+        self.ser = await self.loop.run_in_executor(None, open_serial, dev)
+        self.fd = self.ser.fileno()
+        os.set_blocking(self.fd, False)
+        self.loop.add_reader(self.fd, self.__readable)
+
+    def close(self):
+
+        if self.ser != None:
+            self.loop.remove_reader(self.fd)
+            self.ser.close()
+            self.ser = None
+
+    async def __aenter__(self):
+
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+
+        self.close()
+
+    async def send(self, cmd, *params):
+
+        return await self.run([ cmd ] + [ str(p) for p in params ])
+
+    async def run(self, rc_commands):
+
+        rc_commands = list(rc_commands)
+        sent = []
+
+        async with self.lock:
+            # macros depend on state after previous commands
+            if len(rc_commands) > 0 and rc_commands[0] == "macro":
+                rc_commands = build_macro(rc_commands[1:], self.receiver)
+
+            commands = build_binary_commands_from_rc(rc_commands,
+                                                     receiver = self.receiver)
+            if self.coalesce:
+                commands = coalesce_commands(commands)
+
+            for cmd in commands:
+                if self.elide and is_redundant(cmd, self.receiver):
+                    continue
+
+                await asyncio.sleep(max(0, self.ready - time.monotonic()))
+
+                gap = pacing_gap(cmd["cmd"])
+                if cmd["frame"] != None and self.ack:
+                    gap = await self.__send_and_wait_for_ack(cmd)
+                elif cmd["frame"] != None:
+                    await self.__send_package(cmd["frame"])
+
+                track_command(cmd, self.receiver)
+                count_metric("denon_commands_total", cmd = cmd["cmd"],
+                             port = self.ser.port)
+                self.ready = time.monotonic() + gap
+                sent.append(cmd["rc_cmd"])
+
+        return sent
+
+    async def __send_and_wait_for_ack(self, cmd):
+
+        timeout = PACING[pacing_class(cmd["cmd"])]
+        waiter = (cmd["frame"][5], self.loop.create_future())
+        self.waiters.append(waiter)
+
+        start = time.monotonic()
+        try:
+            await self.__send_package(cmd["frame"])
+            await asyncio.wait_for(waiter[1], timeout)
+            pacing_feedback(cmd["cmd"], time.monotonic() - start)
+            return 0
+
+        except asyncio.TimeoutError:
+            pacing_feedback(cmd["cmd"], None)
+            return max(0, timeout - (time.monotonic() - start))
+
+        finally:
+            self.waiters.remove(waiter)
+
+    async def __send_package(self, package):
+
+        # same as ser.sendBreak() but without blocking
+        if BREAK != "none":
+            self.ser.break_condition = True
+            await asyncio.sleep(BREAK_DURATION)
+            self.ser.break_condition = False
+
+        start = time.monotonic()
+        view = memoryview(package)
+        while len(view) > 0:
+            try:
+                view = view[os.write(self.fd, view):]
+
+            except BlockingIOError:
+                writable = self.loop.create_future()
+                self.loop.add_writer(self.fd, lambda: writable.done()
+                                     or writable.set_result(None))
+                try:
+                    await writable
+                finally:
+                    self.loop.remove_writer(self.fd)
+
+        observe_metric("denon_write_seconds", time.monotonic() - start)
+        count_metric("denon_bytes_written_total", len(package),
+                     port = self.ser.port)
+
+    def __readable(self):
+
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.loop.remove_reader(self.fd)
+            return
+
+        for frame in self.decoder.feed(data):
+            track_status(frame, self.receiver)
+            for opcode, future in self.waiters:
+                if (not future.done() and len(frame.data) > 0
+                        and frame.data[0] == opcode):
+                    future.set_result(frame)
+
+            if self.on_status != None:
+                self.on_status(frame)
+
+
+
+
+def __dispatch(commands):
+
+    if len(commands) == 2 and commands[0] == "help" and commands[1] in COMMANDS:
+        print(__build_help(COMMANDS[commands[1]]))
+    elif len(commands) == 0 or commands[0] == "help":
+        print(__help())
+    else:
+        sendto_denon(commands)
+
+
+
+
+class _ClientStream:
+
+    def __init__(self, f):
+
+        self.f = f
+        self.closed = False
+
+    def write(self, s):
+
+        # client may have gone, but commands must be completed anyway
+        if not self.closed:
+            try:
+                self.f.write(s)
+            except OSError:
+                self.closed = True
+
+        return len(s)
+
+    def flush(self):
+
+        if not self.closed:
+            try:
+                self.f.flush()
+            except OSError:
+                self.closed = True
+
+
+
+
+def __priority(commands):
+
+    # first command of request that is not an option or port
+    i = 0
+    while i < len(commands) and (commands[i].startswith("--")
+                                 or commands[i].startswith("/")):
+        i += 2 if commands[i] in __VALUE_OPTIONS else 1
+
+    if i == len(commands) or commands[i] not in PRIORITIES:
+        return PRIORITIES["default"]
+
+    return PRIORITIES[commands[i]]
+
+
+
+
+def __submit(commands, out, priority = None, options = None,
+             segments = None):
+
+    global __job_seq
+
+    # options and segments are given if request has been validated already
+    if priority == None:
+        priority = __priority(commands)
+
+    job = {
+        "commands" : commands,
+        "out" : out,
+        "submitted" : time.monotonic(),
+        "options" : options,
+        "segments" : segments,
+        "priority" : priority,
+        "cancelled" : False,
+        "started" : False,
+        "rc" : 0,
+        "done" : threading.Event()
+        }
+
+    kinds = __setter_kinds(commands)
+
+    with __scheduler:
+        if kinds != None:
+            __drop_superseded(kinds, priority)
+
+        __job_seq += 1
+        heapq.heappush(__jobs, (priority, __job_seq, job))
+        __scheduler.notify()
+
+    return job
+
+
+
+
+def __setter_kinds(commands):
+
+    # kinds of state that request sets absolutely, e.g. volume of slider
+    # moves, or None if request does anything else
+    lines = commands if len(commands) > 0 and type(commands[0]) == list \
+        else [ commands ]
+
+    kinds = set()
+    for rc_commands in lines:
+        if len(rc_commands) == 0 or rc_commands[0].startswith(("-", "/")):
+            return None
+
+        try:
+            binary_commands = build_binary_commands_from_rc(rc_commands)
+        except HelpException:
+            return None
+
+        for cmd in binary_commands:
+            args = cmd["rc_cmd"].split()[1:]
+            kind, value = __state_of(cmd["cmd"], args[0] if len(args) > 0
+                                     else None)
+            if (kind not in __STATE_KINDS or kind in ("power", "source")
+                    or cmd.get("coalesce") == False):
+                return None
+            kinds.add(kind)
+
+    return kinds
+
+
+
+
+def __drop_superseded(kinds, priority):
+
+    # pending requests of same priority that only set what is set again by
+    # new request, e.g. queued volume of previous slider moves
+    dropped = []
+    for entry in __jobs:
+        job = entry[2]
+        if (entry[0] == priority and not job["started"]
+                and not job["cancelled"]):
+            job_kinds = __setter_kinds(job["commands"])
+            if job_kinds != None and job_kinds <= kinds:
+                dropped.append(entry)
+
+    for entry in dropped:
+        __jobs.remove(entry)
+        job = entry[2]
+        job["out"].write(" INFO: Superseded by newer request\n")
+        job["done"].set()
+
+    if len(dropped) > 0:
+        heapq.heapify(__jobs)
+
+
+
+
+def __cancel():
+
+    # jobs stop at next safe boundary, i.e. between steps of macro, pending
+    # interactive commands of other clients are kept
+    with __scheduler:
+        jobs = [ job for priority, seq, job in __jobs
+                 if priority >= PRIORITIES["macro"] ]
+        if (__current != None
+                and __current["priority"] >= PRIORITIES["macro"]):
+            jobs.append(__current)
+
+        for job in jobs:
+            job["cancelled"] = True
+
+    return len(jobs)
+
+
+
+
+def __run_step(job):
+
+    # sends next step of job, returns True if there are more steps
+    try:
+        if job["segments"] == None:
+            job["options"] = __prepare(job["commands"])
+            if job["options"]["group"] != None:
+                raise HelpException(" ERROR: Option --group is not"
+                                    + " supported in daemon mode.")
+
+            if job["commands"][0] == "replay":
+                raise HelpException(" ERROR: Command replay is not"
+                                    + " supported in daemon mode.")
+
+            if job["options"]["record"] != None or job["options"]["metrics"] \
+                    not in (None, METRICS):
+                raise HelpException(" ERROR: Options --record and --metrics"
+                                    + " of requests are not supported in"
+                                    + " daemon mode.")
+
+            __select_port(job["options"]["port"])
+            if job["commands"] == ["listen"]:
+                listen()
+
+            job["segments"] = __segments(job["commands"])
+
+        # job that has sent its last step is done
+        segment = next(job["segments"], None)
+        if segment == None:
+            return False
+
+        if job["cancelled"]:
+            print(" INFO: Request cancelled")
+            job["rc"] = 1
+            return False
+
+        deadline = job["options"]["deadline"]
+        if deadline != None and time.monotonic() - job["submitted"] > deadline:
+            print(" WARN: Deadline of " + str(deadline)
+                  + " seconds exceeded, request dropped")
+            job["rc"] = 1
+            return False
+
+        send_serial_commands(__segment_commands([ segment ], job["options"]),
+                             ack = job["options"]["ack"],
+                             elide = job["options"]["elide"])
+        return True
+
+    except HelpException as e:
+        print(e.message)
+        job["rc"] = 1
+
+    except serial.SerialException as e:
+        # reopen port on next request
+        print(" FATAL: " + str(e))
+        __close_serial()
+        job["rc"] = 1
+
+    return False
+
+
+
+
+def __run_jobs():
+
+    global __current
+
+    while True:
+        with __scheduler:
+            while len(__jobs) == 0:
+                __scheduler.wait()
+
+            priority, seq, job = heapq.heappop(__jobs)
+            job["started"] = True
+            __current = job
+
+        with contextlib.redirect_stdout(job["out"]):
+            more = __run_step(job)
+
+        # requeue job so that requests of higher priority are sent first
+        with __scheduler:
+            __current = None
+            if more:
+                heapq.heappush(__jobs, (priority, seq, job))
+
+        if not more:
+            if job["segments"] != None:
+                job["segments"].close()
+            if metrics_file != None:
+                write_metrics(metrics_file)
+            if recording != None:
+                recording.flush()
+            job["done"].set()
+
+
+
+
+def __serve_client(conn):
+
+    f = conn.makefile("rw", buffering = 1, encoding = "utf-8")
+    out = _ClientStream(f)
+    rc = 0
+
+    try:
+        commands = json.loads(f.readline())
+        if type(commands) != list:
+            raise ValueError()
+
+        if len(commands) == 0 or commands[0] == "help":
+            if len(commands) == 2 and commands[1] in COMMANDS:
+                out.write(__build_help(COMMANDS[commands[1]]) + "\n")
+            else:
+                out.write(__help() + "\n")
+
+        elif commands == ["cancel"]:
+            out.write(" INFO: Cancelled " + str(__cancel()) + " requests\n")
+
+        elif commands == ["metrics"]:
+            out.write(metrics_text())
+
+        else:
+            job = __submit(commands, out)
+            job["done"].wait()
+            rc = job["rc"]
+
+    except ValueError:
+        out.write(" ERROR: Invalid request.\n")
+        rc = 1
+
+    out.write("\0" + str(rc) + "\n")
+    out.flush()
+    conn.close()
+
+
+
+
+def error_json(e):
+
+    # last line of error message without help text
+    message = ""
+    for line in e.message.splitlines():
+        if "ERROR:" in line or "FATAL:" in line:
+            message = line.split(":", 1)[1].strip()
+
+    rv = { "error" : e.error if e.error != None else "error",
+           "message" : message }
+    rv.update(e.details)
+
+    return rv
+
+
+
+
+def http_request(method, path, body):
+
+    # returns status and JSON object or text of reply of HTTP gateway
+    path = path.split("?")[0]
+    try:
+        if method == "GET" and path == "/state":
+            return 200, { "port" : port, "state" : dict(state) }
+
+        elif method == "GET" and path == "/metrics":
+            return 200, metrics_text()
+
+        elif method == "POST" and path == "/commands":
+            return __http_commands(body)
+
+        return 404, { "error" : "not-found",
+                      "message" : "No such endpoint <" + method + " "
+                      + path + ">" }
+
+    except HelpException as e:
+        return 400, error_json(e)
+
+
+
+
+def __http_commands(body):
+
+    # e.g. { "commands" : [ "on fm", "macro preset 24", [ "vol", "12" ] ],
+    #        "elide" : true }
+    try:
+        request = json.loads(body)
+    except ValueError:
+        raise HelpException(" ERROR: Request is not valid JSON.",
+                            "invalid-request")
+
+    if type(request) == list:
+        request = { "commands" : request }
+
+    if type(request) != dict or type(request.get("commands")) != list:
+        raise HelpException(" ERROR: List of commands is missing.",
+                            "invalid-request")
+
+    options = __parse_options([])
+    for option in ("ack", "elide", "coalesce", "reset_levels", "deadline"):
+        if option not in request:
+            continue
+
+        value = request[option]
+        if (option == "deadline" and type(value) not in (int, float)
+                or option != "deadline" and type(value) != bool):
+            raise HelpException(" ERROR: Invalid value of option <" + option
+                                + ">.", "invalid-option", option = option)
+
+        options[option] = value
+
+    lines = []
+    for i in range(len(request["commands"])):
+        line = request["commands"][i]
+        if type(line) == str:
+            try:
+                line = shlex.split(line)
+            except ValueError as e:
+                raise HelpException(" ERROR: Invalid command <" + line
+                                    + ">: " + str(e) + ".", "invalid-request",
+                                    line = i)
+        if type(line) != list or len(line) == 0 or any([ type(t) != str
+                                                         for t in line ]):
+            raise HelpException(" ERROR: Invalid command <" + str(line)
+                                + ">.", "invalid-request", line = i)
+        lines.append(line)
+
+    if len(lines) == 0:
+        raise HelpException(" ERROR: No command given.", "invalid-request")
+
+    # levels of scenes are absolute
+    if any([ line[0] == "scene" for line in lines ]):
+        options["reset_levels"] = True
+
+    # whole batch is validated before anything is sent
+    for i in range(len(lines)):
+        try:
+            __validate(list(lines[i]), options)
+        except HelpException as e:
+            e.details["line"] = i
+            raise
+
+    out = io.StringIO()
+    job = __submit(lines, out, max([ __priority(line) for line in lines ]),
+                   options, __batch_segments(lines))
+    job["done"].wait()
+
+    rv = { "output" : out.getvalue().splitlines(), "state" : dict(state) }
+    if job["rc"] != 0:
+        rv["error"] = "not-sent"
+        return 503, rv
+
+    return 200, rv
+
+
+
+
+def __validate(rc_commands, options):
+
+    if rc_commands[0] == "scene":
+        __scene_plan(" ".join(rc_commands[1:]))
+        return
+
+    if rc_commands[0] == "macro":
+        segments = list(build_macro_segments(rc_commands[1:]))
+        rc_commands = [ t for segment in segments for t in segment ]
+
+    build_binary_commands_from_rc(rc_commands,
+                                  reset_levels = options["reset_levels"])
+
+
+
+
+def __batch_segments(lines):
+
+    for i in range(len(lines)):
+        label = "Command " + str(i + 1) + " of batch"
+        if lines[i][0] == "scene":
+            name = " ".join(lines[i][1:])
+            for segment in __scene_steps(name, __scene_plan(name)):
+                yield label, segment
+            continue
+
+        if lines[i][0] != "macro":
+            yield label, lines[i]
+            continue
+
+        for segment in build_macro_segments(lines[i][1:]):
+            yield label, segment
+
+
+
+
+def start_http(address):
+
+    import http.server
+
+    class GatewayHandler(http.server.BaseHTTPRequestHandler):
+
+        # keep connections open for further requests
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+
+            self.reply(*http_request("GET", self.path, None))
+
+        def do_POST(self):
+
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+            except ValueError:
+                length = 0
+
+            self.reply(*http_request("POST", self.path,
+                                     self.rfile.read(length)))
+
+        def reply(self, status, payload):
+
+            if type(payload) == str:
+                body = payload.encode("utf-8")
+                content_type = "text/plain; version=0.0.4"
+            else:
+                body = json.dumps(payload).encode("utf-8")
+                content_type = "application/json"
+
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+
+            pass
+
+    host, sep, http_port = address.rpartition(":")
+    try:
+        server = http.server.ThreadingHTTPServer((host or "127.0.0.1",
+                                                  int(http_port)),
+                                                 GatewayHandler)
+    except (ValueError, OSError) as e:
+        raise HelpException(" FATAL: Can't start HTTP gateway on <" + address
+                            + ">: " + str(e))
+
+    server.daemon_threads = True
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    print(" INFO: HTTP gateway on <" + (host or "127.0.0.1") + ":"
+          + http_port + ">")
+
+    return server
+
+
+
+
+def __open_socket(path):
+
+    import socket
+
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            raise HelpException(" FATAL: Daemon is already running on <"
+                                + path + ">")
+        except OSError:
+            # stale socket of a daemon that has died
+            os.unlink(path)
+        finally:
+            probe.close()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(8)
+
+    return server
+
+
+
+
+def run_daemon(args):
+
+    global port, keep_open, metrics_file
+    global ACK, ELIDE, COALESCE, RESET_LEVELS, DEADLINE
+
+    options = __parse_options(args)
+
+    if len(args) > 0 and args[0].startswith("/"):
+        port = args.pop(0)
+
+    # options may also follow port
+    __parse_options(args, options)
+    if len(args) > 0:
+        raise HelpException(" ERROR: Daemon takes no commands, <"
+                            + " ".join(args) + "> given.")
+
+    if options["group"] != None or options["sync"]:
+        raise HelpException(" ERROR: Options --group and --sync are not"
+                            + " supported in daemon mode.")
+
+    # options of daemon are defaults of each request
+    ACK = options["ack"]
+    ELIDE = options["elide"]
+    COALESCE = options["coalesce"]
+    RESET_LEVELS = options["reset_levels"]
+    DEADLINE = options["deadline"]
+
+    metrics_file = options["metrics"]
+    if options["record"] != None and recording == None:
+        start_recording(options["record"])
+
+    load_config()
+
+    # open port once and keep it open for all requests
+    __init_serial()
+    keep_open = True
+
+    server = __open_socket(SOCKET)
+    print(" INFO: Listening on <" + SOCKET + ">")
+
+    threading.Thread(target = __run_jobs, daemon = True).start()
+
+    if options["http"] != None:
+        start_http(options["http"])
+
+    try:
+        while True:
+            conn, addr = server.accept()
+            threading.Thread(target = __serve_client, args = (conn, ),
+                             daemon = True).start()
+
+    finally:
+        server.close()
+        os.unlink(SOCKET)
+        keep_open = False
+        __close_serial()
+        stop_recording()
+
+
+
+
+def run_client(commands):
+
+    import socket
+
+    # daemon reads scripts relative to its own working directory
+    commands = list(commands)
+    if "-f" in commands and commands.index("-f") + 1 < len(commands):
+        i = commands.index("-f") + 1
+        commands[i] = os.path.abspath(commands[i])
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(SOCKET)
+    except OSError:
+        # no daemon running, so talk to serial port directly
+        client.close()
+        __dispatch(commands)
+        return 0
+
+    with client:
+        f = client.makefile("rw", encoding = "utf-8")
+        f.write(json.dumps(commands) + "\n")
+        f.flush()
+
+        rc = 1
+        for line in f:
+            if line.startswith("\0"):
+                rc = int(line[1:])
+                break
+            sys.stdout.write(line)
+
+    return rc
+
+
+
+
+if __name__ == "__main__":
 
     try:
         commands = sys.argv[1:]
-        if len(commands) == 2 and commands[0] == "help" and commands[1] in COMMANDS:
-            print(__build_help(COMMANDS[commands[1]]))
-        elif len(commands) == 0 or commands[0] == "help":
-            print(__help())
+        if len(commands) > 0 and commands[0] == "daemon":
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            run_daemon(commands[1:])
+        elif len(commands) > 0 and commands[0] == "client":
+            exit(run_client(commands[1:]))
         else:
-            sendto_denon(commands)
+            __dispatch(commands)
 
     except HelpException as e:
         print(e.message)
         exit(1)
+
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,397 @@
+#!/usr/bin/python3
+#
+# MIT License
+#
+# Copyright (c) 2017 heckie75
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+
+
+import denon
+import denon_emulator
+import contextlib
+import io
+import json
+import os
+import pty
+import select
+import platform
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+# mix of commands with and without parameters
+RC_COMMANDS = [ "on", "fm", "vol", "12", "mute", "off", "num", "+10",
+                "num", "4", "bass", "+", "dimmer", "low", "sleep", "90",
+                "set-alarm", "everyday", "06:30", "07:45", "preset24" ]
+
+# calls of script whose time is mostly startup, e.g. input validation of GUI
+STARTUP = {
+    "help" : [ "help", "vol" ],
+    "invalid" : [ "vol", "99" ]
+    }
+
+MACROS = {
+    "set-preset-name" : [ "set-preset-name", "24", "BBC World" ],
+    "delete-preset" : [ "delete-preset", "1", "99" ]
+    }
+
+
+
+
+def __timeit(func, iterations):
+
+    start = time.perf_counter()
+    for i in range(iterations):
+        func()
+
+    return time.perf_counter() - start
+
+
+
+
+def __percentiles(samples):
+
+    samples = sorted(samples)
+    rv = {}
+    for p in (50, 90, 99):
+        rv["p" + str(p)] = samples[min(len(samples) - 1,
+                                       len(samples) * p // 100)]
+    rv["max"] = samples[-1]
+
+    return rv
+
+
+
+
+def bench_parse(iterations):
+
+    commands = len(denon.build_binary_commands_from_rc(list(RC_COMMANDS)))
+    elapsed = __timeit(
+        lambda: denon.build_binary_commands_from_rc(list(RC_COMMANDS)),
+        iterations)
+
+    return {
+        "commands" : commands * iterations,
+        "seconds" : elapsed,
+        "commands_per_second" : commands * iterations / elapsed
+        }
+
+
+
+
+def bench_encode(iterations):
+
+    data = [ 64, 0, 12 ]
+    elapsed = __timeit(lambda: denon.__build_package(data), iterations)
+
+    return {
+        "frames" : iterations,
+        "seconds" : elapsed,
+        "frames_per_second" : iterations / elapsed
+        }
+
+
+
+
+def bench_macro(iterations):
+
+    rv = {}
+    for name in MACROS:
+        rc_commands = denon.build_macro(list(MACROS[name]))
+        commands = denon.build_binary_commands_from_rc(list(rc_commands))
+        expand = __timeit(lambda: denon.build_macro(list(MACROS[name])),
+                          iterations)
+        encode = __timeit(lambda: denon.build_binary_commands_from_rc(
+                              denon.build_macro(list(MACROS[name]))),
+                          iterations)
+
+        rv[name] = {
+            "tokens" : len(rc_commands),
+            "commands" : len(commands),
+            "expand_seconds" : expand / iterations,
+            "expand_and_encode_seconds" : encode / iterations
+            }
+
+    return rv
+
+
+
+
+def bench_e2e(iterations):
+
+    emulator = denon_emulator.Emulator(status = True, verbose = False)
+    path = emulator.open()
+    worker = threading.Thread(target = emulator.run, daemon = True)
+    worker.start()
+
+    frames = [ c["frame"] for c in
+               denon.build_binary_commands_from_rc(list(RC_COMMANDS))
+               if c["frame"] != None ]
+
+    denon.port = path
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            denon.__init_serial()
+        denon.start_reader()
+
+        # latency from write until receiver has replied status frame
+        latencies = []
+        for i in range(iterations):
+            frame = frames[i % len(frames)]
+            start = time.perf_counter()
+            denon.__send_package(frame)
+            try:
+                denon.status_frames.get(timeout = 1)
+            except queue.Empty:
+                continue
+            latencies.append(time.perf_counter() - start)
+
+        # throughput of frames that are written back to back
+        received = emulator.decoder.frames
+        start = time.perf_counter()
+        for i in range(iterations):
+            denon.__send_package(frames[i % len(frames)])
+
+        while emulator.decoder.frames - received < iterations:
+            if time.perf_counter() - start > 60:
+                break
+            time.sleep(.001)
+
+        elapsed = time.perf_counter() - start
+
+    finally:
+        denon.__close_serial()
+        emulator.close()
+        worker.join()
+
+    rv = {
+        "frames" : iterations,
+        "frames_per_second" : (emulator.decoder.frames - received) / elapsed,
+        "replies" : len(latencies)
+        }
+
+    if len(latencies) > 0:
+        rv["latency_seconds"] = __percentiles(latencies)
+
+    return rv
+
+
+
+
+def __read_pty(fd, data, stop):
+
+    # raw bytes that are written to serial port
+    while not stop.is_set():
+        r, w, x = select.select([ fd ], [], [], .05)
+        if fd in r:
+            try:
+                data += os.read(fd, 4096)
+            except OSError:
+                break
+
+
+
+
+def bench_framing(iterations):
+
+    commands = denon.build_binary_commands_from_rc(list(RC_COMMANDS))
+    expected = b"".join([ c["frame"] for c in commands
+                          if c["frame"] != None ]) * iterations
+
+    pacing = dict(denon.PACING)
+    mode = (denon.BREAK, denon.BREAK_DURATION)
+
+    rv = {}
+    try:
+        # no gaps so that frames are written in bursts if mode allows
+        for cls in denon.PACING:
+            denon.PACING[cls] = 0
+
+        for name in denon.BREAK_MODES:
+            denon.BREAK = name
+            denon.BREAK_DURATION = .01
+
+            master, slave = pty.openpty()
+            denon.port = os.ttyname(slave)
+            data = bytearray()
+            stop = threading.Event()
+            worker = threading.Thread(target = __read_pty,
+                                      args = (master, data, stop))
+            worker.start()
+
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                denon.send_serial_commands(commands * iterations)
+            elapsed = time.perf_counter() - start
+
+            time.sleep(.1)
+            stop.set()
+            worker.join()
+            os.close(slave)
+            os.close(master)
+
+            rv[name] = {
+                "frames" : len(commands) * iterations,
+                "seconds" : elapsed,
+                "identical" : bytes(data) == expected
+                }
+
+    finally:
+        denon.PACING.update(pacing)
+        denon.BREAK, denon.BREAK_DURATION = mode
+        denon.port = denon.PORT
+
+    return rv
+
+
+
+
+def __import_times(report):
+
+    # modules that are imported directly by denon, see python -X importtime
+    rv = {}
+    for line in report.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+
+        cumulative, name = line.split("|")[1:]
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            rv[name.strip()] = int(cumulative)
+        elif name.strip() == "denon":
+            rv["total"] = int(cumulative)
+            break
+        elif depth == 0:
+            rv = {}
+
+    return rv
+
+
+
+
+def bench_startup(iterations):
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "denon.py")
+
+    rv = {}
+    for name in STARTUP:
+        samples = []
+        for i in range(iterations):
+            start = time.perf_counter()
+            subprocess.run([ sys.executable, script ] + STARTUP[name],
+                           stdout = subprocess.DEVNULL,
+                           stderr = subprocess.DEVNULL)
+            samples.append(time.perf_counter() - start)
+
+        rv[name + "_seconds"] = __percentiles(samples)
+
+    p = subprocess.run([ sys.executable, "-X", "importtime", "-c",
+                         "import denon" ],
+                       cwd = os.path.dirname(script),
+                       stderr = subprocess.PIPE, universal_newlines = True)
+    rv["import_microseconds"] = __import_times(p.stderr)
+
+    return rv
+
+
+
+
+BENCHMARKS = {
+    "parse" : (bench_parse, 10000),
+    "encode" : (bench_encode, 100000),
+    "macro" : (bench_macro, 1000),
+    "e2e" : (bench_e2e, 500),
+    "framing" : (bench_framing, 5),
+    "startup" : (bench_startup, 20)
+    }
+
+
+
+
+def run(names, scale = 1):
+
+    results = {
+        "python" : platform.python_version(),
+        "machine" : platform.machine(),
+        "time" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "benchmarks" : {}
+        }
+
+    for name in names:
+        func, iterations = BENCHMARKS[name]
+        results["benchmarks"][name] = func(max(1, int(iterations * scale)))
+
+    return results
+
+
+
+
+def __usage():
+
+    return """ Benchmarks for Denon DRA-F109 command line remote control
+
+ USAGE:   denon_bench.py [--scale <factor>] [--output <file>] [<benchmark> ...]
+ EXAMPLE: Run all benchmarks with tenth of iterations
+          $ ./denon_bench.py --scale .1 --output bench.json
+
+ Benchmarks: """ + ", ".join(BENCHMARKS) + "\n"
+
+
+
+
+if __name__ == "__main__":
+
+    args = sys.argv[1:]
+    scale = 1
+    output = None
+    names = []
+
+    try:
+        while len(args) > 0:
+            arg = args.pop(0)
+            if arg == "--scale":
+                scale = float(args.pop(0))
+            elif arg == "--output":
+                output = args.pop(0)
+            elif arg in BENCHMARKS:
+                names.append(arg)
+            else:
+                raise ValueError()
+
+    except (IndexError, ValueError):
+        print(__usage())
+        exit(1)
+
+    if len(names) == 0:
+        names = list(BENCHMARKS)
+
+    s = json.dumps(run(names, scale), indent = 2)
+    if output != None:
+        with open(output, "w") as f:
+            f.write(s + "\n")
+    else:
+        print(s)
@@ -0,0 +1,366 @@
+#!/usr/bin/python3
+#
+# MIT License
+#
+# Copyright (c) 2017 heckie75
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+
+
+import denon
+import os
+import sys
+import time
+import random
+import select
+import tty
+import signal
+
+PRESETS = 40
+NAME_LENGTH = 8
+
+ALARM_SOURCES = ["preset", "analog1", "analog2", "optical", "net", "netusb",
+                 "cd", "cdusb"]
+
+
+
+
+def encode(payload):
+
+    package = bytes([ 255, 85, len(payload) - 2, 1, 0 ]) + payload
+
+    return package + bytes([ sum(package) % 256 ])
+
+
+
+
+class Emulator:
+
+    def __init__(self, status = False, latency = 0, corrupt = 0,
+                 verbose = True):
+
+        self.status = status
+        self.latency = latency
+        self.corrupt = corrupt
+        self.verbose = verbose
+
+        self.master = None
+        self.slave = None
+        self.running = False
+        self.decoder = denon.FrameDecoder()
+        self.received = bytearray()
+        self.log = []
+
+        self.state = {
+            "power" : "off",
+            "source" : "net",
+            "volume" : 0,
+            "mute" : "off",
+            "dimmer" : "high",
+            "sdb" : "off",
+            "sdirect" : "off",
+            "bass" : 0,
+            "treble" : 0,
+            "balance" : 0,
+            "standby" : "off",
+            "sleep" : 0,
+            "alarm" : "off",
+            "mode" : "stereo",
+            "preset" : 1,
+            "presets" : dict([ (i, "PRESET" + str(i))
+                               for i in range(1, PRESETS + 1) ]),
+            "alarms" : {}
+            }
+
+        # menus of receiver
+        self.tens = 0
+        self.menu = None
+        self.enters = 0
+        self.cleared = False
+        self.cursor = 0
+        self.name = []
+        self.last_key = None
+        self.taps = 0
+
+    def open(self):
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.running = True
+
+        return os.ttyname(self.slave)
+
+    def close(self):
+
+        self.running = False
+        for fd in (self.master, self.slave):
+            if fd != None:
+                os.close(fd)
+
+        self.master = self.slave = None
+
+    def run(self):
+
+        while self.running:
+            try:
+                r, w, x = select.select([ self.master ], [], [], .2)
+                if len(r) == 0:
+                    continue
+
+                data = os.read(self.master, 1024)
+
+            except (OSError, ValueError, TypeError):
+                # emulator has been closed
+                break
+
+            self.received += data
+            errors = self.decoder.errors
+            for frame in self.decoder.feed(data):
+                self.handle(frame)
+
+            if self.decoder.errors > errors and self.verbose:
+                print(" WARN: Frame with invalid checksum received")
+
+    def handle(self, frame):
+
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        self.log.append((time.monotonic(), frame))
+        if frame.kind == "unknown":
+            self.__alarm(frame.data)
+        else:
+            self.__command(frame.kind, frame.value)
+
+        if self.verbose:
+            print(" RECV: " + frame.kind + " <" + str(frame.value) + ">")
+
+        if self.status:
+            self.__reply(frame.data)
+
+    def __reply(self, payload):
+
+        package = bytearray(encode(payload))
+        if self.corrupt > 0 and random.random() < self.corrupt:
+            package[random.randrange(len(package))] ^= 1 << random.randrange(8)
+
+        os.write(self.master, package)
+
+    def __command(self, kind, value):
+
+        state = self.state
+
+        if kind in ("power", "source", "volume", "mute", "dimmer", "sdb",
+                    "sdirect", "standby", "sleep", "alarm"):
+            state[kind] = value
+
+        elif kind in ("bass", "treble"):
+            step = 1 if value == "+" else -1
+            if state[kind] + step in denon.LEVELS[kind]:
+                state[kind] += step
+
+        elif kind == "balance":
+            step = 1 if value == "right" else -1
+            if state[kind] + step in denon.LEVELS[kind]:
+                state[kind] += step
+
+        elif kind == "mode":
+            state["mode"] = "mono" if state["mode"] == "stereo" else "stereo"
+
+        elif kind == "preset":
+            step = 1 if value == "+" else -1
+            state["preset"] = (state["preset"] + step - 1) % PRESETS + 1
+
+        elif kind == "num":
+            self.__num(value)
+
+        elif self.menu == "name":
+            self.__edit_name(kind)
+
+        elif kind == "clear":
+            self.cleared = True
+            self.enters = 0
+
+        elif kind == "enter":
+            self.__enter()
+
+    def __num(self, value):
+
+        if self.menu == "name":
+            if value == "+10":
+                return
+
+            key = value
+            if key == self.last_key:
+                self.taps += 1
+            else:
+                self.taps = 0
+
+            self.last_key = key
+            keys = denon.KEY_PAD[key]
+            self.name[self.cursor] = keys[self.taps % len(keys)]
+
+        elif value == "+10":
+            self.tens += 10
+
+        else:
+            preset = self.tens + value
+            self.tens = 0
+            self.enters = 0
+            self.cleared = False
+            # digits select tracks of other sources
+            if (self.state["source"] == "fm"
+                    and preset in self.state["presets"]):
+                self.state["preset"] = preset
+
+    def __enter(self):
+
+        preset = self.state["preset"]
+        if self.cleared:
+            # clear and enter deletes current preset
+            self.state["presets"][preset] = ""
+            self.cleared = False
+            return
+
+        self.enters += 1
+        if self.enters == 2:
+            # two times enter starts editing name of current preset
+            self.enters = 0
+            self.menu = "name"
+            self.cursor = 0
+            self.last_key = None
+            self.name = list(self.state["presets"][preset]
+                             .ljust(NAME_LENGTH)[:NAME_LENGTH])
+
+    def __edit_name(self, kind):
+
+        if kind == "clear":
+            # works like backspace
+            self.name[self.cursor] = " "
+            self.cursor = max(0, self.cursor - 1)
+
+        elif kind == "right":
+            self.cursor = min(NAME_LENGTH - 1, self.cursor + 1)
+
+        elif kind == "left":
+            self.cursor = max(0, self.cursor - 1)
+
+        elif kind == "enter":
+            preset = self.state["preset"]
+            self.state["presets"][preset] = "".join(self.name).rstrip()
+            self.menu = None
+
+        self.last_key = None
+
+    def __alarm(self, payload):
+
+        # set-alarm is encoded dynamically, so it isn't in the frame table
+        if len(payload) == 9 and payload[0] in (136, 137):
+            timer = "once" if payload[0] == 136 else "everyday"
+            self.state["alarms"][timer] = {
+                "on" : "%02i:%02i" % (payload[3], payload[4]),
+                "off" : "%02i:%02i" % (payload[6], payload[7]),
+                "source" : ALARM_SOURCES[payload[8]]
+                    if payload[8] < len(ALARM_SOURCES) else payload[8]
+                }
+
+
+
+
+def __usage():
+
+    return """ Denon DRA-F109 emulator on pseudo terminal
+
+ USAGE:   denon_emulator.py [--status] [--latency <ms>] [--corrupt <rate>]
+                            [--link <path>] [--quiet]
+ EXAMPLE: Start emulator and send commands to it
+          $ ./denon_emulator.py --status
+           INFO: Emulating receiver on </dev/pts/3>
+          $ ./denon.py /dev/pts/3 on fm vol 12
+
+ --status          Replies status frame for each command
+ --latency <ms>    Delays handling of commands
+ --corrupt <rate>  Corrupts status frames with given rate, e.g. 0.1
+ --link <path>     Creates symbolic link to pseudo terminal
+ --quiet           Doesn't print received commands
+"""
+
+
+
+
+if __name__ == "__main__":
+
+    args = sys.argv[1:]
+    options = {
+        "status" : False,
+        "latency" : 0,
+        "corrupt" : 0,
+        "verbose" : True
+        }
+    link = None
+
+    try:
+        while len(args) > 0:
+            arg = args.pop(0)
+            if arg == "--status":
+                options["status"] = True
+            elif arg == "--latency":
+                options["latency"] = float(args.pop(0)) / 1000
+            elif arg == "--corrupt":
+                options["corrupt"] = float(args.pop(0))
+            elif arg == "--link":
+                link = args.pop(0)
+            elif arg == "--quiet":
+                options["verbose"] = False
+            else:
+                raise ValueError()
+
+    except (IndexError, ValueError):
+        print(__usage())
+        exit(1)
+
+    emulator = Emulator(**options)
+    path = emulator.open()
+    if link != None:
+        if os.path.islink(link):
+            os.unlink(link)
+        os.symlink(path, link)
+        path = link
+
+    print(" INFO: Emulating receiver on <" + path + ">")
+    sys.stdout.flush()
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        emulator.run()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        if link != None:
+            os.unlink(link)
+        emulator.close()
+        print(" INFO: " + str(emulator.decoder.frames) + " frames received, "
+              + str(emulator.decoder.errors) + " invalid")
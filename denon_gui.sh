@@ -1,6 +1,9 @@
 #!/bin/bash
 DIR="$(dirname "$0")"
-DENON="ssh 192.168.178.28 $HOME/bin/denon.py"
+DENON="ssh 192.168.178.28 $HOME/bin/denon.py client"
+# set URL of HTTP gateway of daemon in order to avoid SSH and start of Python
+# for each command, e.g. "http://192.168.178.28:8080"
+DENON_HTTP=""
 ME="$DIR/denon_cli.sh"
 ICON="$HOME/opt/denon.png"
 
@@ -99,9 +102,28 @@ function ask_schedule() {
   echo $s
 }
 
+function denon() {
+  if [ "$DENON_HTTP" == "" ]
+  then
+    $DENON $@
+  else
+    # words of arguments are one command line like for $DENON, they are
+    # escaped for JSON, exit status reflects HTTP status
+    body=""
+    for word in $*
+    do
+      word="${word//\\/\\\\}"
+      word="${word//\"/\\\"}"
+      word="${word//[[:cntrl:]]/}"
+      body="$body${body:+, }\"$word\""
+    done
+    curl -sf -d "{\"commands\": [[$body]]}" "$DENON_HTTP/commands"
+  fi
+}
+
 if [ "$DISPLAY" == "" ]
 then
-  $DENON  $@
+  denon $@
   exit $?
 fi
 
@@ -290,5 +312,5 @@ esac
 
 # execute
 param="$atype $start $stop $source$param"
-$DENON $command $param & notify-send -i $ICON "DENON Remote Control" "$command $param"
+denon $command $param & notify-send -i $ICON "DENON Remote Control" "$command $param"
 
@@ -0,0 +1,627 @@
+#!/usr/bin/python3
+#
+# MIT License
+#
+# Copyright (c) 2017 heckie75
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+
+
+
+import denon
+import denon_emulator
+import asyncio
+import contextlib
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+# pacing of receiver is tightened so that tests run fast
+CONFIG = """[pacing]
+""" + "".join([ cls + " = .02\n" for cls in denon.PACING ]) + """
+[scene evening]
+source = fm
+preset = 24
+volume = 12
+
+[scene late]
+source = fm
+preset = 24
+volume = 6
+"""
+
+# seconds until daemon has opened port and socket
+STARTUP = 5
+
+
+
+
+def emulated(emulator, kind, value):
+
+    # emulator reads frames in background, so wait a bit for expected value
+    start = time.monotonic()
+    while emulator.state[kind] != value and time.monotonic() - start < 2:
+        time.sleep(.01)
+
+    return emulator.state[kind]
+
+
+
+
+class DaemonTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        cls.home = tempfile.TemporaryDirectory()
+        with open(os.path.join(cls.home.name, ".denon.conf"), "w") as f:
+            f.write(CONFIG)
+
+        cls.emulator = denon_emulator.Emulator(verbose = False)
+        path = cls.emulator.open()
+        cls.worker = threading.Thread(target = cls.emulator.run,
+                                      daemon = True)
+        cls.worker.start()
+
+        cls.socket = os.path.join(cls.home.name, "denon.sock")
+        env = dict(os.environ, HOME = cls.home.name)
+        cls.daemon = subprocess.Popen([ sys.executable, "-c",
+            "import denon, sys; denon.SOCKET = sys.argv[1]; "
+            + "denon.run_daemon(sys.argv[2:])", cls.socket, path ],
+            cwd = os.path.dirname(os.path.abspath(__file__)), env = env,
+            stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+
+        start = time.monotonic()
+        while not os.path.exists(cls.socket):
+            if time.monotonic() - start > STARTUP:
+                raise RuntimeError("daemon has not started")
+            time.sleep(.05)
+
+    @classmethod
+    def tearDownClass(cls):
+
+        cls.daemon.terminate()
+        cls.daemon.wait()
+        cls.emulator.close()
+        cls.worker.join()
+        cls.home.cleanup()
+
+    def client(self, *commands):
+
+        # request is answered or fails within timeout, it must not hang
+        out = io.StringIO()
+        rv = {}
+        def request():
+            with contextlib.redirect_stdout(out):
+                rv["rc"] = denon.run_client(list(commands))
+
+        denon.SOCKET = self.socket
+        worker = threading.Thread(target = request, daemon = True)
+        worker.start()
+        worker.join(10)
+        self.assertFalse(worker.is_alive(), "request has not been answered")
+
+        return rv["rc"], out.getvalue()
+
+    def test_command(self):
+
+        rc, out = self.client("vol", "12")
+        self.assertEqual(rc, 0, out)
+        self.assertIn(" DONE: <vol 12>", out)
+        self.assertEqual(emulated(self.emulator, "volume", 12), 12)
+
+        # daemon still serves following requests
+        rc, out = self.client("vol", "7")
+        self.assertEqual(rc, 0, out)
+        self.assertEqual(emulated(self.emulator, "volume", 7), 7)
+
+    def test_macro(self):
+
+        rc, out = self.client("macro", "preset", "24")
+        self.assertEqual(rc, 0, out)
+        self.assertEqual(emulated(self.emulator, "source", "fm"), "fm")
+        self.assertEqual(emulated(self.emulator, "preset", 24), 24)
+
+    def test_preset_name(self):
+
+        rc, out = self.client("macro", "set-preset-name", "19", "BBC World")
+        self.assertEqual(rc, 0, out)
+        time.sleep(.2)
+        self.assertEqual(self.emulator.state["presets"][19], "BBC WORL")
+
+        # only chars that differ are typed
+        rc, out = self.client("macro", "set-preset-name", "19", "BBC Radio",
+                              "BBC World")
+        self.assertEqual(rc, 0, out)
+        self.assertEqual(out.count(" DONE: <clear>"), 4)
+        time.sleep(.2)
+        self.assertEqual(self.emulator.state["presets"][19], "BBC RADI")
+
+    def test_relative_script(self):
+
+        with tempfile.TemporaryDirectory() as cwd:
+            with open(os.path.join(cwd, "script.txt"), "w") as f:
+                f.write("vol 11\n")
+
+            previous = os.getcwd()
+            os.chdir(cwd)
+            try:
+                rc, out = self.client("-f", "script.txt")
+            finally:
+                os.chdir(previous)
+
+        self.assertEqual(rc, 0, out)
+        self.assertEqual(emulated(self.emulator, "volume", 11), 11)
+
+    def test_scene(self):
+
+        rc, out = self.client("scene", "evening")
+        self.assertEqual(rc, 0, out)
+        self.assertEqual(emulated(self.emulator, "volume", 12), 12)
+
+        # only volume differs from known state
+        frames = len(self.emulator.log)
+        rc, out = self.client("scene", "late")
+        self.assertEqual(rc, 0, out)
+        self.assertEqual(emulated(self.emulator, "volume", 6), 6)
+        self.assertEqual(len(self.emulator.log) - frames, 1)
+
+    def test_invalid_command(self):
+
+        rc, out = self.client("vol", "99")
+        self.assertEqual(rc, 1)
+        self.assertIn("out of allowed range", out)
+
+        rc, out = self.client("vol", "3")
+        self.assertEqual(rc, 0, out)
+
+
+
+
+class TrackTest(unittest.TestCase):
+
+    def track(self, rc_commands):
+
+        receiver = denon.new_receiver()
+        for cmd in denon.build_binary_commands_from_rc(rc_commands.split(),
+                                                       receiver = receiver):
+            denon.track_command(cmd, receiver)
+
+        return receiver
+
+    def test_preset_of_fm_only(self):
+
+        receiver = self.track("fm num 5 cd num +10 num +10 num 9")
+        self.assertEqual(receiver["state"]["preset"], 5)
+        self.assertEqual(denon.build_macro([ "preset", "30" ], receiver)[:2],
+                         [ "fm", "wait" ])
+
+    def test_source_unknown_after_on(self):
+
+        receiver = self.track("fm num 5 off on")
+        self.assertNotIn("source", receiver["state"])
+        self.assertNotIn("preset", receiver["state"])
+        net = denon.build_binary_commands_from_rc([ "net" ])[0]
+        self.assertFalse(denon.is_redundant(net, receiver))
+
+    def test_ignored_in_standby(self):
+
+        receiver = self.track("off vol 12 on")
+        self.assertNotIn("volume", receiver["state"])
+        vol = denon.build_binary_commands_from_rc([ "vol", "12" ])[0]
+        self.assertFalse(denon.is_redundant(vol, receiver))
+
+
+
+
+class CoalesceTest(unittest.TestCase):
+
+    def test_coalesce(self):
+
+        for rc_commands, expected in [
+                ("vol 10 vol 11 vol 12", [ "vol 12" ]),
+                ("bass + bass -", []),
+                ("bass + bass + bass -", [ "bass +" ]),
+                ("mode mode", []),
+                ("fm vol 5 cd", [ "vol 5", "cd" ]),
+                ("vol 5 wait vol 6", [ "vol 5", "wait", "vol 6" ]),
+                ("fm up fm", [ "fm", "up", "fm" ]) ]:
+            commands = denon.build_binary_commands_from_rc(
+                           rc_commands.split(), receiver = denon.new_receiver())
+            self.assertEqual([ cmd["rc_cmd"] for cmd in
+                               denon.coalesce_commands(commands) ],
+                             expected, rc_commands)
+
+
+
+
+class PlanTest(unittest.TestCase):
+
+    def test_plan_preset(self):
+
+        plan_preset = getattr(denon, "__plan_preset")
+        for preset, current, expected in [
+                (3, None, "num 3"),
+                (24, None, "num +10 num +10 num 4"),
+                (24, 23, "preset +"),
+                (21, 23, "preset - preset -"),
+                (40, 1, "num +10 num +10 num +10 num +10 num 0") ]:
+            receiver = denon.new_receiver()
+            if current != None:
+                receiver["state"]["preset"] = current
+            self.assertEqual(" ".join(plan_preset(preset, receiver)),
+                             expected, (preset, current))
+
+    def test_plan_preset_name(self):
+
+        plan_preset_name = getattr(denon, "__plan_preset_name")
+        for name, previous, expected in [
+                ("AB", "AB", ""),
+                ("AB", "AC", "right clear right num 2 num 2"),
+                ("A", "AB", "right clear right"),
+                ("AB", None, "clear num 2 right clear right num 2 num 2"
+                             + " right clear right" * 6) ]:
+            self.assertEqual(" ".join(plan_preset_name(name, previous)),
+                             expected, (name, previous))
+
+
+
+
+class CaptureTest(unittest.TestCase):
+
+    def test_round_trip(self):
+
+        commands = denon.build_binary_commands_from_rc(
+                       "on wait vol 12 set-alarm once 07:00 08:00 preset24"
+                       .split())
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "capture.bin")
+            denon.start_recording(path)
+            try:
+                for cmd in commands:
+                    getattr(denon, "__record")(cmd)
+            finally:
+                denon.stop_recording()
+
+            captured = denon.read_capture([ path ])
+
+        self.assertEqual([ (cmd["rc_cmd"], cmd["frame"]) for cmd in captured ],
+                         [ (cmd["rc_cmd"], cmd["frame"]) for cmd in commands ])
+        self.assertEqual(sorted([ cmd["at"] for cmd in captured ]),
+                         [ cmd["at"] for cmd in captured ])
+
+    def test_truncated(self):
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "capture.bin")
+            with open(path, "wb") as f:
+                f.write(denon.RECORD_MAGIC + b"\x00" * 5)
+
+            with self.assertRaises(denon.HelpException):
+                denon.read_capture([ path ])
+
+
+
+
+class DecoderTest(unittest.TestCase):
+
+    def frame(self, *rc_commands):
+
+        return denon.build_binary_commands_from_rc(list(rc_commands))[0][
+            "frame"]
+
+    def test_corrupted_length(self):
+
+        decoder = denon.FrameDecoder()
+        frames = decoder.feed(b"\xff\x55\xfe" + self.frame("vol", "12"))
+        self.assertEqual([ (f.kind, f.value) for f in frames ],
+                         [ ("volume", 12) ])
+        self.assertEqual(decoder.errors, 1)
+
+    def test_resync(self):
+
+        vol = self.frame("vol", "12")
+        mute = self.frame("mute", "on")
+        corrupted = vol[:-1] + bytes([ (vol[-1] + 1) % 256 ])
+        for chunks, expected, errors in [
+                ([ b"\x00\x12" + vol ], [ ("volume", 12) ], 0),
+                ([ vol[:4], vol[4:] + mute ],
+                 [ ("volume", 12), ("mute", "on") ], 0),
+                ([ b"\xff" ] + [ bytes([ b ]) for b in vol ],
+                 [ ("volume", 12) ], 0),
+                ([ corrupted + mute ], [ ("mute", "on") ], 1),
+                ([ b"\xff\x55\x01\x00" + vol ], [ ("volume", 12) ], 1) ]:
+            decoder = denon.FrameDecoder()
+            frames = []
+            for chunk in chunks:
+                frames += decoder.feed(chunk)
+
+            self.assertEqual([ (f.kind, f.value) for f in frames ], expected,
+                             chunks)
+            self.assertEqual(decoder.errors, errors, chunks)
+
+
+
+
+class CancelTest(unittest.TestCase):
+
+    def test_keep_interactive_requests(self):
+
+        jobs = [ (denon.PRIORITIES[commands[0]], seq,
+                  { "commands" : commands, "cancelled" : False })
+                 for seq, commands in enumerate([ [ "vol", "5" ],
+                                                  [ "macro", "preset", "3" ],
+                                                  [ "-f", "script.txt" ] ]) ]
+
+        with unittest.mock.patch.object(denon, "__jobs", list(jobs)):
+            self.assertEqual(getattr(denon, "__cancel")(), 2)
+
+        self.assertEqual([ job["cancelled"] for priority, seq, job in jobs ],
+                         [ False, True, True ])
+
+    def test_keep_current_interactive_request(self):
+
+        current = { "commands" : [ "vol", "5" ], "cancelled" : False,
+                    "priority" : denon.PRIORITIES["vol"] }
+        with unittest.mock.patch.object(denon, "__jobs", []), \
+                unittest.mock.patch.object(denon, "__current", current):
+            self.assertEqual(getattr(denon, "__cancel")(), 0)
+
+        self.assertFalse(current["cancelled"])
+
+    def test_deadline_after_last_step(self):
+
+        job = { "commands" : [ "vol", "12" ], "segments" : None,
+                "cancelled" : False, "submitted" : time.monotonic(),
+                "rc" : 0 }
+        def send(commands, ack, elide):
+            list(commands)
+            time.sleep(.05)
+
+        with unittest.mock.patch.object(denon, "load_config"), \
+                unittest.mock.patch.object(denon, "send_serial_commands",
+                                           send):
+            run_step = getattr(denon, "__run_step")
+            self.assertTrue(run_step(job))
+
+            # nothing is left to drop
+            job["options"]["deadline"] = .01
+            self.assertFalse(run_step(job))
+
+        self.assertEqual(job["rc"], 0)
+
+    def test_reject_record(self):
+
+        job = { "commands" : [ "--record", "cap.bin", "vol", "12" ],
+                "segments" : None, "rc" : 0 }
+        out = io.StringIO()
+        with unittest.mock.patch.object(denon, "load_config"), \
+                contextlib.redirect_stdout(out):
+            self.assertFalse(getattr(denon, "__run_step")(job))
+
+        self.assertEqual(job["rc"], 1)
+        self.assertIn("--record", out.getvalue())
+
+    def test_priority_after_options(self):
+
+        priority = getattr(denon, "__priority")
+        self.assertEqual(priority([ "--record", "cap.bin", "vol", "12" ]),
+                         denon.PRIORITIES["vol"])
+        self.assertEqual(priority([ "--group", "a,b", "/dev/ttyUSB0",
+                                    "macro", "preset", "3" ]),
+                         denon.PRIORITIES["macro"])
+
+
+
+
+class SupersedeTest(unittest.TestCase):
+
+    def test_drop_pending_setters(self):
+
+        submit = getattr(denon, "__submit")
+        jobs = []
+        with unittest.mock.patch.object(denon, "__jobs", jobs):
+            running = submit([ "vol", "10" ], io.StringIO())
+            running["started"] = True
+            macro = submit([ "macro", "preset", "3" ], io.StringIO())
+            pending = submit([ "vol", "11" ], io.StringIO())
+            batch = submit([ [ "mute", "off" ], [ "vol", "12" ] ],
+                           io.StringIO(), denon.PRIORITIES["vol"])
+            latest = submit([ "vol", "13" ], io.StringIO())
+
+        # only volume of latest slider move is sent after running request
+        self.assertEqual([ job for priority, seq, job in sorted(jobs) ],
+                         [ running, batch, latest, macro ])
+        self.assertTrue(pending["done"].is_set())
+        self.assertIn("Superseded", pending["out"].getvalue())
+
+
+
+
+class ReconnectTest(unittest.TestCase):
+
+    def test_resume_burst(self):
+
+        class Port:
+
+            port = "/dev/ttyUSB0"
+
+            def __init__(self):
+                self.written = []
+                self.failures = 1
+
+            def sendBreak(self, duration):
+                pass
+
+            def write(self, frame):
+                # port dies while second frame is written
+                if len(self.written) == 1 and self.failures > 0:
+                    self.failures -= 1
+                    raise OSError("device disconnected")
+                self.written.append(frame)
+
+            def flush(self):
+                pass
+
+        getattr(denon, "__import_serial")()
+        port = Port()
+        frames = [ b"1", b"2", b"3" ]
+        with unittest.mock.patch.object(denon, "ser", port), \
+                unittest.mock.patch.object(denon, "BREAK", "burst"), \
+                unittest.mock.patch.object(denon, "__reconnect"), \
+                contextlib.redirect_stdout(io.StringIO()):
+            getattr(denon, "__send_frames")(frames)
+
+        self.assertEqual(port.written, frames)
+
+
+
+
+class HttpTest(unittest.TestCase):
+
+    def test_invalid_requests(self):
+
+        for body, error in [ (b'xx', "invalid-request"),
+                             (b'{"commands": ["vol \\"12"]}',
+                              "invalid-request"),
+                             (b'["vol 99"]', "out-of-range"),
+                             (b'["foo"]', "invalid-command") ]:
+            status, rv = denon.http_request("POST", "/commands", body)
+            self.assertEqual((status, rv["error"]), (400, error), body)
+
+
+
+
+class PortCacheTest(unittest.TestCase):
+
+    def test_swapped_adapter(self):
+
+        adapter = unittest.mock.Mock(vid = 0x067b, pid = 0x2303,
+                                     serial_number = "A1")
+        with tempfile.TemporaryDirectory() as cache, \
+                unittest.mock.patch.object(denon, "PORT_CACHE",
+                    os.path.join(cache, "denon.port")), \
+                unittest.mock.patch.object(denon, "__usb_ids",
+                    lambda dev: (0x067b, 0x2303, "A1")):
+            getattr(denon, "__cache_port")(os.devnull, adapter)
+            self.assertEqual(getattr(denon, "__cached_port")(), os.devnull)
+
+            # same device name but other adapter after replugging
+            with unittest.mock.patch.object(denon, "__usb_ids",
+                    lambda dev: (0x067b, 0x2303, "B2")):
+                self.assertEqual(getattr(denon, "__cached_port")(), None)
+
+
+
+
+class GroupTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.emulators = []
+        self.ports = {}
+        for name in ("living", "kitchen"):
+            emulator = denon_emulator.Emulator(verbose = False)
+            self.ports[name] = emulator.open()
+            threading.Thread(target = emulator.run, daemon = True).start()
+            self.emulators.append(emulator)
+
+    def tearDown(self):
+
+        for emulator in self.emulators:
+            emulator.close()
+
+    def test_failed_receiver(self):
+
+        send_package = getattr(denon, "__send_package")
+        def failing(package, s = None):
+            if s.port == self.ports["kitchen"]:
+                raise OSError("break failed")
+            send_package(package, s)
+
+        out = io.StringIO()
+        with unittest.mock.patch.dict(denon.PORTS, self.ports), \
+                unittest.mock.patch.dict(denon.PACING,
+                                         dict.fromkeys(denon.PACING, .02)), \
+                unittest.mock.patch.object(denon, "config_loaded", True), \
+                unittest.mock.patch.object(denon, "__send_package", failing), \
+                contextlib.redirect_stdout(out):
+
+            # other receiver must not wait for failed one forever
+            with self.assertRaises(denon.HelpException) as e:
+                denon.sendto_denon([ "--group", "living,kitchen", "--sync",
+                                     "vol", "5", "cd" ])
+
+        self.assertIn("kitchen>", e.exception.message)
+        self.assertIn("break failed", out.getvalue())
+
+
+
+
+class AsyncDenonTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.emulators = []
+        self.paths = []
+        for i in range(2):
+            emulator = denon_emulator.Emulator(status = True, verbose = False)
+            self.paths.append(emulator.open())
+            threading.Thread(target = emulator.run, daemon = True).start()
+            self.emulators.append(emulator)
+
+    def tearDown(self):
+
+        for emulator in self.emulators:
+            emulator.close()
+
+    def test_state_per_receiver(self):
+
+        async def send():
+            async with denon.AsyncDenon(self.paths[0],
+                                        elide = True) as a, \
+                       denon.AsyncDenon(self.paths[1],
+                                        elide = True) as b:
+                await a.send("vol", 12)
+                await b.send("vol", 12)
+                return a.state, b.state
+
+        a, b = asyncio.run(send())
+        self.assertEqual(a["volume"], 12)
+        self.assertEqual(b["volume"], 12)
+        for emulator in self.emulators:
+            self.assertEqual(emulated(emulator, "volume", 12), 12)
+
+
+
+
+if __name__ == "__main__":
+
+    unittest.main()